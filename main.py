@@ -1,12 +1,20 @@
 import asyncio
+import base64
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import hmac
 import os
+import struct
 import time
 import random
 import asyncpg
+from collections import OrderedDict
 from decimal import Decimal
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 import pytz
@@ -27,33 +35,880 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
-storage = MemoryStorage()
+# Размеры пулов по классам нагрузки: интерактивные хендлеры, фоновые задачи и рассылки
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 5))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_BACKGROUND_POOL_MIN_SIZE = int(os.getenv('DB_BACKGROUND_POOL_MIN_SIZE', 1))
+DB_BACKGROUND_POOL_MAX_SIZE = int(os.getenv('DB_BACKGROUND_POOL_MAX_SIZE', 3))
+DB_BULK_POOL_MIN_SIZE = int(os.getenv('DB_BULK_POOL_MIN_SIZE', 0))
+DB_BULK_POOL_MAX_SIZE = int(os.getenv('DB_BULK_POOL_MAX_SIZE', 2))
+# Средняя задержка захвата соединения (сек), при которой пул расширяется
+DB_POOL_GROW_WAIT = float(os.getenv('DB_POOL_GROW_WAIT', 0.05))
+# Через сколько секунд простоя asyncpg закрывает соединение: так пул сжимается после снижения лимита
+DB_POOL_IDLE_LIFETIME = float(os.getenv('DB_POOL_IDLE_LIFETIME', 300))
+
+# Топ игроков в памяти: сколько держим и как часто перечитываем в любом случае (сек)
+TOP_CACHE_SIZE = 50
+TOP_CACHE_TTL = int(os.getenv('TOP_CACHE_TTL', 60))
+
+# Напоминания о ежедневной награде: период прохода (сек), размер пачки
+# и минимальная пауза между сообщениями (сек), чтобы не упереться в лимиты Telegram
+BONUS_REMINDER_INTERVAL = int(os.getenv('BONUS_REMINDER_INTERVAL', 3600))
+BONUS_REMINDER_BATCH = int(os.getenv('BONUS_REMINDER_BATCH', 100))
+BONUS_REMINDER_MIN_DELAY = float(os.getenv('BONUS_REMINDER_MIN_DELAY', 0.05))
+# На сколько секунд отправок вперёд помечаем пользователей: столько напоминаний теряется при падении
+BONUS_REMINDER_CLAIM_AHEAD = float(os.getenv('BONUS_REMINDER_CLAIM_AHEAD', 30))
+
+# Как часто перечитываем промокоды целиком (сек) — на случай правок в обход бота
+PROMO_CACHE_TTL = int(os.getenv('PROMO_CACHE_TTL', 60))
+# На сколько слотов делим остаток промокода, чтобы активации не ждали друг друга
+PROMO_SLOTS = int(os.getenv('PROMO_SLOTS', 16))
+
+# Страницы списка турниров: сколько доверяем странице (сек), ведь за это время может начаться новый турнир
+TOURNAMENT_PAGE_TTL = int(os.getenv('TOURNAMENT_PAGE_TTL', 60))
+
+# Сколько индексов мест неактивных турниров (завершённых, других страниц списка) держим в памяти
+TOURNAMENT_RANK_CACHE_SIZE = int(os.getenv('TOURNAMENT_RANK_CACHE_SIZE', 4))
+
+# Для скольких пользователей помним число наград
+TROPHY_COUNT_CACHE_SIZE = int(os.getenv('TROPHY_COUNT_CACHE_SIZE', 10000))
+
+# Подписка на канал: сколько доверяем результату get_chat_member (сек)
+# и сколько пользователей перепроверяем в фоне за один проход
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 600))
+SUBSCRIPTION_RECHECK_BATCH = int(os.getenv('SUBSCRIPTION_RECHECK_BATCH', 50))
+
+# Сколько последних нажатий кнопок помним для защиты от двойных нажатий
+CALLBACK_DEDUP_SIZE = int(os.getenv('CALLBACK_DEDUP_SIZE', 200000))
+# Дневные партиции used_buttons: сколько дней создаём наперёд и сколько храним
+BUTTON_PARTITION_AHEAD_DAYS = 3
+BUTTON_PARTITION_RETENTION_DAYS = 2
+
+# Эфемерные таблицы (состояния, приглашения, нажатия кнопок) без WAL: запись дешевле,
+# но после аварийной остановки Postgres такие таблицы очищаются целиком — незавершённые
+# сценарии сбрасываются в меню, а старые кнопки можно нажать ещё раз. Плановый рестарт
+# данные сохраняет. На реплики UNLOGGED-таблицы не попадают
+EPHEMERAL_TABLES_UNLOGGED = os.getenv('EPHEMERAL_TABLES_UNLOGGED', '0') == '1'
+# Запас места на странице под новую версию строки при upsert: она остаётся на той же странице
+EPHEMERAL_TABLES_FILLFACTOR = int(os.getenv('EPHEMERAL_TABLES_FILLFACTOR', 70))
+
+# Ключ подписи ставок в кнопках повтора; по умолчанию выводится из токена бота
+CALLBACK_SECRET = (os.getenv('CALLBACK_SECRET') or hashlib.sha256(f"callback:{BOT_TOKEN}".encode()).hexdigest()).encode()
+
+# Состояния пользователей: размер LRU в памяти, срок жизни (сек) и период записи в БД (сек)
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', 10000))
+STATE_TTL = int(os.getenv('STATE_TTL', 86400))
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 1.0))
+
+# ===== FSM STORAGE =====
+
+class TieredStorage(BaseStorage):
+    """FSM-хранилище: LRU в памяти поверх таблицы user_states.
+
+    Запись ключуется по user_id — бот работает в личных чатах. Изменения
+    копятся в dirty и раз в flush_interval секунд пишутся в БД одним
+    запросом, поэтому серия set_state/set_data за один ход игры даёт один
+    upsert. Записи старше ttl считаются пустыми и в памяти, и в БД.
+    """
+
+    def __init__(self, size: int, ttl: int, flush_interval: float):
+        self.size = size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # user_id -> [state, data, updated_at]
+        self.cache = OrderedDict()
+        self.dirty = {}
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def encode(state, data) -> str:
+        import json
+        return json.dumps({'state': state, 'data': data})
+
+    @staticmethod
+    def decode(raw):
+        import json
+        try:
+            value = json.loads(raw)
+        except (TypeError, ValueError):
+            # Старый формат: имя состояния без JSON
+            return raw, {}
+        if isinstance(value, dict) and set(value) == {'state', 'data'}:
+            return value['state'], value['data'] or {}
+        if isinstance(value, dict):
+            # Старый формат: словарь с необязательным ключом state
+            return value.get('state'), value
+        return None, {}
+
+    def _remember(self, user_id: int, record: list):
+        self.cache[user_id] = record
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def _record(self, user_id: int) -> list:
+        now = time.time()
+        record = self.dirty.get(user_id) or self.cache.get(user_id)
+        if record is None:
+            async with db_connection() as conn:
+                row = await sql_fetchrow(conn, 'get_user_state', user_id, float(self.ttl))
+            # Пока шёл запрос, запись могли обновить
+            record = self.dirty.get(user_id) or self.cache.get(user_id)
+            if record is None:
+                state, data = self.decode(row['state_data']) if row else (None, {})
+                record = [state, data, now - row['age'] if row else now]
+
+        if now - record[2] > self.ttl:
+            record = [None, {}, now]
+        self._remember(user_id, record)
+        return record
+
+    def prime(self, user_id: int, raw, age):
+        """Кладёт в кэш запись, прочитанную вместе с контекстом пользователя"""
+        if user_id in self.dirty or user_id in self.cache:
+            return
+        state, data = self.decode(raw) if raw is not None else (None, {})
+        self._remember(user_id, [state, data, time.time() - (age or 0)])
+
+    def _store(self, user_id: int, state, data: dict):
+        record = [state, data, time.time()]
+        self._remember(user_id, record)
+        self.dirty[user_id] = record
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._record(key.user_id)
+        self._store(key.user_id, getattr(state, 'state', state), record[1])
+
+    async def get_state(self, key: StorageKey):
+        return (await self._record(key.user_id))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        record = await self._record(key.user_id)
+        self._store(key.user_id, record[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._record(key.user_id))[1])
+
+    async def flush(self):
+        """Записывает накопленные изменения: upsert непустых записей и удаление пустых"""
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            batch, self.dirty = self.dirty, {}
+            upserts = {uid: r for uid, r in batch.items() if r[0] is not None or r[1]}
+            deletes = [uid for uid in batch if uid not in upserts]
+            try:
+                async with db_connection() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await sql_execute(conn, 'flush_user_states', list(upserts),
+                                              [self.encode(r[0], r[1]) for r in upserts.values()])
+                        if deletes:
+                            await sql_execute(conn, 'delete_user_states', deletes)
+            except Exception:
+                # Возвращаем в очередь всё, что не успели перезаписать заново
+                for uid, record in batch.items():
+                    self.dirty.setdefault(uid, record)
+                raise
+
+    async def expire(self):
+        """Убирает просроченные записи из памяти и из БД"""
+        now = time.time()
+        for uid in [uid for uid, r in self.cache.items() if now - r[2] > self.ttl]:
+            del self.cache[uid]
+        async with background_pool.acquire() as conn:
+            return await sql_execute(conn, 'cleanup_user_states', float(self.ttl))
+
+    async def close(self) -> None:
+        await self.flush()
+
+storage = TieredStorage(STATE_CACHE_SIZE, STATE_TTL, STATE_FLUSH_INTERVAL)
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=storage)
+# FSM-мидлварь подключается ниже, после загрузки контекста пользователя: иначе она
+# читала бы состояние отдельным запросом раньше, чем контекст принесёт его вместе с пользователем
+dp = Dispatcher(storage=storage, disable_fsm=True)
 
 BOT_USERNAME = None
 db_pool = None
+background_pool = None
+bulk_pool = None
+
+# ===== SQL REGISTRY =====
+# Все запросы бота собраны здесь: каждое новое соединение пула подготавливает их заранее
+
+SQL = {
+    'get_user_state': '''SELECT state_data, EXTRACT(EPOCH FROM NOW() - updated_at)::float8 AS age
+           FROM user_states
+           WHERE user_id = $1 AND updated_at > NOW() - make_interval(secs => $2)''',
+    'flush_user_states': '''INSERT INTO user_states (user_id, state_data, updated_at)
+           SELECT user_id, state_data, NOW() FROM unnest($1::bigint[], $2::text[]) AS t(user_id, state_data)
+           ON CONFLICT (user_id)
+           DO UPDATE SET state_data = EXCLUDED.state_data, updated_at = NOW()''',
+    'delete_user_states': 'DELETE FROM user_states WHERE user_id = ANY($1::bigint[])',
+    'claim_button': '''INSERT INTO used_buttons (button_key, used_on, used_at)
+           VALUES ($1, $2, NOW())
+           ON CONFLICT (button_key, used_on) DO NOTHING
+           RETURNING button_key''',
+    'get_pending_referral': 'SELECT referrer_id FROM pending_referrals WHERE user_id = $1',
+    'set_pending_referral': '''INSERT INTO pending_referrals (user_id, referrer_id, created_at)
+           VALUES ($1, $2, NOW())
+           ON CONFLICT (user_id)
+           DO UPDATE SET referrer_id = $2, created_at = NOW()''',
+    'delete_pending_referral': 'DELETE FROM pending_referrals WHERE user_id = $1',
+    'list_button_partitions': '''SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           JOIN pg_class p ON p.oid = i.inhparent
+           WHERE p.relname = 'used_buttons' ORDER BY c.relname''',
+    'get_table_storage': '''SELECT relname, relpersistence, reloptions FROM pg_class
+           WHERE relname = ANY($1::text[]) AND relkind = 'r' AND pg_table_is_visible(oid)''',
+    'cleanup_user_states': 'DELETE FROM user_states WHERE updated_at < NOW() - make_interval(secs => $1)',
+    'cleanup_pending_referrals': "DELETE FROM pending_referrals WHERE created_at < NOW() - INTERVAL '24 hours'",
+    'get_user': 'SELECT user_id, name, username, balance, refs, last_bonus FROM users WHERE user_id = $1',
+    'load_user_context': '''WITH created AS (
+               INSERT INTO users (user_id, name, username, balance, refs, last_bonus)
+               SELECT $1, $2, $3, 0, 0, 0
+               WHERE $4
+               ON CONFLICT (user_id) DO NOTHING
+               RETURNING user_id, name, username, balance, refs, last_bonus
+           ), u AS (
+               SELECT * FROM created
+               UNION ALL
+               SELECT user_id, name, username, balance, refs, last_bonus FROM users WHERE user_id = $1
+           )
+           SELECT u.user_id, u.name, u.username, u.balance, u.refs, u.last_bonus,
+                  EXISTS(SELECT 1 FROM created) AS created,
+                  s.state_data, EXTRACT(EPOCH FROM NOW() - s.updated_at)::float8 AS state_age,
+                  p.referrer_id
+           FROM (SELECT $1::bigint AS id) k
+           LEFT JOIN u ON u.user_id = k.id
+           LEFT JOIN user_states s ON s.user_id = k.id AND s.updated_at > NOW() - make_interval(secs => $5)
+           LEFT JOIN pending_referrals p ON p.user_id = k.id''',
+    'create_user': '''INSERT INTO users (user_id, name, username, balance, refs, last_bonus)
+           VALUES ($1, $2, $3, 0, 0, 0)
+           ON CONFLICT (user_id) DO NOTHING''',
+    'update_user_balance': 'UPDATE users SET balance = balance + $1 WHERE user_id = $2 RETURNING balance',
+    'get_user_balance': 'SELECT balance FROM users WHERE user_id = $1',
+    'settle_bet': '''UPDATE users SET balance = balance - $1 + $2
+           WHERE user_id = $3 AND balance >= $1
+           RETURNING balance''',
+    'update_daily_bonus': '''UPDATE users SET balance = balance + 0.2, last_bonus = $1
+           WHERE user_id = $2 AND last_bonus <= $3
+           RETURNING balance''',
+    'lock_referrer': 'SELECT user_id, balance, refs FROM users WHERE user_id = $1 FOR UPDATE',
+    'credit_referrer': 'UPDATE users SET balance = balance + 2, refs = refs + 1 WHERE user_id = $1 RETURNING balance',
+    # Остаток промокода разложен по слотам promo_slots: активация блокирует один свободный
+    # слот, начиная со случайного ($3), и не ждёт занятые. Первичный ключ promo_redemptions
+    # не даёт активировать код дважды — повторная активация не списывает использование
+    'use_promo': '''WITH s AS (
+               SELECT slot FROM promo_slots
+               WHERE code = $1 AND uses > 0
+               ORDER BY slot < $3, slot
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           ), r AS (
+               INSERT INTO promo_redemptions (user_id, code)
+               SELECT $2, $1 FROM s
+               WHERE EXISTS(SELECT 1 FROM users WHERE user_id = $2)
+               ON CONFLICT (user_id, code) DO NOTHING
+               RETURNING user_id
+           ), d AS (
+               UPDATE promo_slots SET uses = promo_slots.uses - 1
+               FROM s, r
+               WHERE promo_slots.code = $1 AND promo_slots.slot = s.slot
+               RETURNING promo_slots.slot
+           ), credited AS (
+               UPDATE users
+               SET balance = balance + p.reward
+               FROM d, promos p
+               WHERE users.user_id = $2 AND p.code = $1
+               RETURNING p.reward, users.balance
+           )
+           SELECT (SELECT reward FROM credited) AS reward,
+                  (SELECT balance FROM credited) AS balance,
+                  EXISTS(SELECT 1 FROM users WHERE user_id = $2) AS user_exists,
+                  NOT EXISTS(SELECT 1 FROM promo_redemptions WHERE user_id = $2 AND code = $1)
+                      AND NOT (EXISTS(SELECT 1 FROM s) AND NOT EXISTS(SELECT 1 FROM r)) AS not_used,
+                  EXISTS(SELECT 1 FROM s) AS got_slot,
+                  ((SELECT SUM(uses) FROM promo_slots WHERE code = $1) - (SELECT COUNT(*) FROM d))::int AS uses''',
+    'get_top_users': 'SELECT user_id, name, balance FROM users ORDER BY balance DESC LIMIT $1',
+    'withdraw_balance': '''UPDATE users SET balance = balance - $1
+           WHERE user_id = $2 AND balance >= $1
+           RETURNING balance''',
+    'create_tournament': '''INSERT INTO tournaments
+           (name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status, start_message)
+           VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7::jsonb, 'active', $8)
+           RETURNING id''',
+    'get_active_tournament': '''SELECT id, name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status
+           FROM tournaments
+           WHERE status = 'active' AND start_time <= $1 AND end_time > $1
+           ORDER BY id DESC LIMIT 1''',
+    'get_next_tournament_start': '''SELECT MIN(start_time) FROM tournaments
+           WHERE status = 'active' AND start_time > $1''',
+    'increment_tournament_refs': '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
+           VALUES ($1, $2, 1)
+           ON CONFLICT (tournament_id, user_id)
+           DO UPDATE SET refs_count = tournament_participants.refs_count + 1
+           RETURNING refs_count''',
+    'get_tournament_ref_counts': 'SELECT user_id, refs_count FROM tournament_participants WHERE tournament_id = $1',
+    'get_user_names': 'SELECT user_id, name, username FROM users WHERE user_id = ANY($1::bigint[])',
+    # Закрытие турнира захватывает его строку: повторный или параллельный вызов ничего не вернёт
+    'close_tournament_for_payout': '''UPDATE tournaments SET status = 'finished'
+           WHERE id = $1 AND status = 'active'
+           RETURNING name, prize_places, prizes, trophy_file_ids''',
+    'get_tournament_winners': '''SELECT user_id, refs_count,
+           ROW_NUMBER() OVER (ORDER BY refs_count DESC, user_id) as place
+           FROM tournament_participants
+           WHERE tournament_id = $1
+           ORDER BY refs_count DESC, user_id
+           LIMIT $2''',
+    'pay_tournament_prizes': '''WITH awarded AS (
+               INSERT INTO user_trophies
+               (user_id, tournament_id, tournament_name, place, trophy_file_id, prize_stars, date_received)
+               SELECT w.user_id, $1, $2, w.place, w.trophy_file_id, w.prize_stars, $3
+               FROM unnest($4::bigint[], $5::int4[], $6::text[], $7::numeric[])
+                    AS w(user_id, place, trophy_file_id, prize_stars)
+               RETURNING user_id, prize_stars
+           )
+           UPDATE users u SET balance = u.balance + a.prize_stars
+           FROM awarded a
+           WHERE u.user_id = a.user_id
+           RETURNING u.user_id, u.balance''',
+    # Награды листаются по ключу (date_received, id): каждая страница — одна строка из индекса
+    'get_first_trophy': '''SELECT id, tournament_name, place, trophy_file_id, prize_stars, date_received
+           FROM user_trophies
+           WHERE user_id = $1
+           ORDER BY date_received DESC, id DESC
+           LIMIT 1''',
+    'get_next_trophy': '''SELECT id, tournament_name, place, trophy_file_id, prize_stars, date_received
+           FROM user_trophies
+           WHERE user_id = $1 AND (date_received, id) < ($2, $3)
+           ORDER BY date_received DESC, id DESC
+           LIMIT 1''',
+    'get_prev_trophy': '''SELECT id, tournament_name, place, trophy_file_id, prize_stars, date_received
+           FROM user_trophies
+           WHERE user_id = $1 AND (date_received, id) > ($2, $3)
+           ORDER BY date_received ASC, id ASC
+           LIMIT 1''',
+    'count_user_trophies': 'SELECT COUNT(*) FROM user_trophies WHERE user_id = $1',
+    'get_admin_tournament_creation_state': 'SELECT step, data FROM admin_tournament_creation WHERE admin_id = $1',
+    'set_admin_tournament_creation_state': '''INSERT INTO admin_tournament_creation (admin_id, step, data, updated_at)
+           VALUES ($1, $2, $3, NOW())
+           ON CONFLICT (admin_id)
+           DO UPDATE SET step = $2, data = $3, updated_at = NOW()''',
+    'delete_admin_tournament_creation_state': 'DELETE FROM admin_tournament_creation WHERE admin_id = $1',
+    'get_all_user_ids': 'SELECT user_id FROM users',
+    'upsert_promo': 'INSERT INTO promos (code, reward, uses) VALUES ($1, $2, $3) ON CONFLICT (code) DO UPDATE SET reward = $2, uses = $3',
+    # Использования делятся между min($2, $3) слотами поровну, остаток — первым слотам
+    'upsert_promo_slots': '''INSERT INTO promo_slots (code, slot, uses)
+           SELECT $1, g, $2::int / c.n + CASE WHEN g < $2::int % c.n THEN 1 ELSE 0 END
+           FROM (SELECT GREATEST(LEAST($2::int, $3::int), 1) AS n) c, generate_series(0, c.n - 1) g
+           ON CONFLICT (code, slot) DO UPDATE SET uses = EXCLUDED.uses''',
+    'trim_promo_slots': 'DELETE FROM promo_slots WHERE code = $1 AND slot >= GREATEST(LEAST($2::int, $3::int), 1)',
+    'list_promos': '''SELECT p.code, p.reward, COALESCE(SUM(s.uses), 0)::int AS uses
+           FROM promos p
+           LEFT JOIN promo_slots s ON s.code = p.code
+           GROUP BY p.code, p.reward
+           ORDER BY p.code''',
+    'find_active_tournament_by_name': '''SELECT id, name, prize_places, prizes, trophy_file_ids
+           FROM tournaments
+           WHERE (UPPER(TRIM(name)) = UPPER(TRIM($1)) OR id::text = $1) AND status = 'active'
+           ORDER BY id DESC LIMIT 1''',
+    'get_active_tournament_page': '''SELECT id, name, start_time, end_time, prize_places, prizes,
+           COUNT(*) OVER () AS total, MIN(end_time) OVER () AS first_end
+           FROM tournaments
+           WHERE status = 'active' AND start_time <= $1 AND end_time > $1
+           ORDER BY start_time ASC, id ASC
+           LIMIT 1 OFFSET $2''',
+    'get_tournament_name': 'SELECT name FROM tournaments WHERE id = $1',
+    # Кому пора напомнить о награде: забирал её раньше $1 и ещё не получал напоминания после этого.
+    # Пачка сразу помечается временем напоминания ($5) и выпадает из частичного индекса
+    'count_bonus_reminder_users': '''SELECT COUNT(*) FROM users
+           WHERE last_reminded_at <= last_bonus AND last_bonus > 0 AND last_bonus < $1''',
+    'claim_bonus_reminder_users': '''WITH batch AS (
+               SELECT user_id FROM users
+               WHERE last_reminded_at <= last_bonus AND last_bonus > 0 AND last_bonus < $1
+               AND (last_bonus, user_id) > ($2, $3)
+               ORDER BY last_bonus, user_id
+               LIMIT $4
+           )
+           UPDATE users u SET last_reminded_at = $5
+           FROM batch b
+           WHERE u.user_id = b.user_id
+           RETURNING u.user_id, u.name, u.last_bonus''',
+    'get_expired_tournaments': '''SELECT id, name FROM tournaments
+           WHERE status = 'active' AND end_time <= $1''',
+    'get_tournament_prizes': 'SELECT prizes FROM tournaments WHERE id = $1',
+    'get_starting_tournaments': '''SELECT id, name, start_message FROM tournaments
+           WHERE status = 'active'
+           AND start_time <= $1
+           AND start_time > $2
+           AND start_message IS NOT NULL''',
+}
+
+# Тот же запрос, но ждёт занятый слот: когда все непустые слоты заблокированы параллельными активациями
+SQL['use_promo_wait'] = SQL['use_promo'].replace('FOR UPDATE SKIP LOCKED', 'FOR UPDATE')
+
+class RegistryConnection(asyncpg.Connection):
+    """Соединение пула: запросы реестра подготавливаются при подключении.
+
+    Подготовленные запросы лежат в кэше именованных запросов asyncpg — тем же
+    путём идут fetch/execute. Объекты PreparedStatement для этого не годятся:
+    asyncpg делает их недействительными при каждом возврате соединения в пул.
+    Публичного способа положить запрос в этот кэш, не выполняя его, у asyncpg
+    нет, поэтому prepare_registry вызывает внутренний Connection._prepare
+    (use_cache=True); при обновлении asyncpg эту сигнатуру нужно сверить.
+    """
+
+    async def prepare_registry(self) -> list:
+        """Подготавливает все запросы реестра. Возвращает имена неподготовленных"""
+        failed = []
+        for name, query in SQL.items():
+            try:
+                await self._prepare(query, use_cache=True)
+            except asyncpg.PostgresError:
+                failed.append(name)
+        return failed
+
+# Статистика запросов: имя -> [количество вызовов, суммарное время в секундах]
+sql_stats = {}
+
+async def prepare_connection(conn):
+    """init-хук пула: подготавливает все запросы реестра на новом соединении"""
+    # При первом запуске таблиц ещё нет — такой запрос подготовится при первом вызове
+    failed = await conn.prepare_registry()
+    if failed:
+        print(f"[DB] Not prepared on connect ({len(failed)}): {', '.join(failed)}")
+
+async def _run_sql(conn, name: str, method: str, args):
+    started = time.perf_counter()
+    try:
+        return await getattr(conn, method)(SQL[name], *args)
+    finally:
+        stats = sql_stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+
+async def sql_fetch(conn, name: str, *args):
+    return await _run_sql(conn, name, 'fetch', args)
+
+async def sql_fetchrow(conn, name: str, *args):
+    return await _run_sql(conn, name, 'fetchrow', args)
+
+async def sql_fetchval(conn, name: str, *args):
+    return await _run_sql(conn, name, 'fetchval', args)
+
+async def sql_execute(conn, name: str, *args):
+    return await _run_sql(conn, name, 'execute', args)
+
+class DBPool:
+    """Пул соединений одного класса нагрузки.
+
+    Число одновременно выданных соединений ограничено адаптивным лимитом
+    между min_size и max_size: autosize() поднимает его, когда захват
+    соединения ждёт дольше DB_POOL_GROW_WAIT, и опускает при простое.
+    Соединения сверх лимита перестают выдаваться, и asyncpg закрывает их
+    сам через DB_POOL_IDLE_LIFETIME секунд простоя.
+    """
+
+    def __init__(self, name: str, min_size: int, max_size: int):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.limit = min(max(min_size, 1), self.max_size)
+        self.pool = None
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._cond = asyncio.Condition()
+        self._acquires = 0
+        self._wait_total = 0.0
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=min(self.min_size, self.max_size),
+            max_size=self.max_size,
+            command_timeout=60,
+            max_inactive_connection_lifetime=DB_POOL_IDLE_LIFETIME,
+            init=prepare_connection,
+            connection_class=RegistryConnection,
+            # Реестр целиком плюс запас под разовые запросы, чтобы они не вытесняли реестр
+            statement_cache_size=len(SQL) + 100,
+            # Без срока жизни: иначе через 300 секунд asyncpg выбросит запрос из кэша
+            # и подготовит его заново уже на пути пользовательского запроса
+            max_cached_statement_lifetime=0
+        )
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_use < self.limit)
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        try:
+            async with self.pool.acquire() as conn:
+                self._acquires += 1
+                self._wait_total += time.perf_counter() - started
+                yield conn
+        finally:
+            async with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+
+    async def autosize(self):
+        """Подстраивает лимит под среднее ожидание захвата за прошедший период"""
+        avg_wait = self._wait_total / self._acquires if self._acquires else 0.0
+        old_limit = self.limit
+        if avg_wait > DB_POOL_GROW_WAIT and self.limit < self.max_size:
+            self.limit += 1
+        elif avg_wait < DB_POOL_GROW_WAIT / 10 and self._peak_in_use < self.limit and self.limit > max(self.min_size, 1):
+            self.limit -= 1
+
+        self._acquires = 0
+        self._wait_total = 0.0
+        self._peak_in_use = self._in_use
+
+        if self.limit != old_limit:
+            print(f"[DB] Pool {self.name}: limit {old_limit} -> {self.limit} (avg wait {avg_wait * 1000:.1f} ms)")
+            async with self._cond:
+                self._cond.notify_all()
+
+    async def expire_connections(self):
+        await self.pool.expire_connections()
+
+    async def close(self):
+        await self.pool.close()
+
+class UnitOfWork:
+    """Одно соединение интерактивного пула на весь апдейт.
+
+    Соединение берётся при первом обращении к БД и переиспользуется всеми
+    хелперами. После выхода из последнего блока работы с БД оно
+    возвращается в пул на первой же паузе (send_dice, sleep, запросы к
+    Telegram), а следующий хелпер возьмёт его заново. Внутри transaction()
+    соединение удерживается до конца транзакции.
+    """
+
+    def __init__(self, pool: DBPool):
+        self.pool = pool
+        self.conn = None
+        self.closed = False
+        self._cm = None
+        self._depth = 0
+        self._owner = None
+        self._release_handle = None
+
+    # Задачи возврата соединений в пул: держим ссылки, чтобы их не собрал GC
+    _releasing = set()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        task = asyncio.current_task()
+        if self.closed or (self._depth and self._owner is not task):
+            # Параллельная задача внутри апдейта получает своё соединение
+            async with self.pool.acquire() as conn:
+                yield conn
+            return
 
-user_states = {}
-used_buttons = {}
-user_sessions = {}
-pending_referrals = {}
+        if self._release_handle is not None:
+            self._release_handle.cancel()
+            self._release_handle = None
+        if self.conn is None:
+            self._cm = self.pool.acquire()
+            self.conn = await self._cm.__aenter__()
+
+        self._depth += 1
+        self._owner = task
+        try:
+            yield self.conn
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._release_handle = asyncio.get_running_loop().call_soon(self._release)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        async with self.connection() as conn:
+            async with conn.transaction():
+                yield conn
+
+    def _release(self):
+        self._release_handle = None
+        if self.conn is not None and not self._depth:
+            cm, self._cm, self.conn = self._cm, None, None
+            task = asyncio.create_task(cm.__aexit__(None, None, None))
+            UnitOfWork._releasing.add(task)
+            task.add_done_callback(UnitOfWork._release_done)
+
+    @staticmethod
+    def _release_done(task):
+        UnitOfWork._releasing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[DB] Failed to release connection: {task.exception()}")
+
+    async def close(self):
+        self.closed = True
+        if self._release_handle is not None:
+            self._release_handle.cancel()
+            self._release_handle = None
+        if self.conn is not None:
+            cm, self._cm, self.conn = self._cm, None, None
+            await cm.__aexit__(None, None, None)
+
+current_uow = contextvars.ContextVar('current_uow', default=None)
+# Пул для работы вне апдейта; фоновые задачи ставят в нём background_pool в начале своей задачи
+current_pool = contextvars.ContextVar('current_pool', default=None)
+
+def db_connection():
+    """Соединение текущего апдейта, а вне апдейта — отдельное из пула задачи (по умолчанию интерактивного)"""
+    uow = current_uow.get()
+    return uow.connection() if uow is not None else (current_pool.get() or db_pool).acquire()
+
+@contextlib.asynccontextmanager
+async def db_transaction():
+    async with db_connection() as conn:
+        async with conn.transaction():
+            yield conn
+
+# ===== MIGRATIONS =====
+
+# Шаги схемы по порядку: (версия, описание, SQL). Ранние шаги идемпотентны,
+# потому что базы до появления schema_version уже содержат часть таблиц
+MIGRATIONS = [
+    (1, 'base tables', '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT NOT NULL,
+            username TEXT,
+            balance DECIMAL(10, 2) DEFAULT 0,
+            refs INTEGER DEFAULT 0,
+            last_bonus BIGINT DEFAULT 0,
+            used_promos TEXT[] DEFAULT ARRAY[]::TEXT[]
+        );
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id BIGINT PRIMARY KEY,
+            state_data TEXT,
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS pending_referrals (
+            user_id BIGINT PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS promos (
+            code TEXT PRIMARY KEY,
+            reward DECIMAL(10, 2) NOT NULL,
+            uses INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tournaments (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            start_time BIGINT NOT NULL,
+            end_time BIGINT NOT NULL,
+            duration_days INTEGER NOT NULL,
+            prize_places INTEGER NOT NULL,
+            prizes JSONB NOT NULL,
+            trophy_file_ids JSONB NOT NULL,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS tournament_participants (
+            tournament_id INTEGER REFERENCES tournaments(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            refs_count INTEGER DEFAULT 0,
+            PRIMARY KEY (tournament_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS user_trophies (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            tournament_id INTEGER REFERENCES tournaments(id),
+            tournament_name TEXT NOT NULL,
+            place INTEGER NOT NULL,
+            trophy_file_id TEXT NOT NULL,
+            prize_stars DECIMAL(10, 2) NOT NULL,
+            date_received BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS admin_tournament_creation (
+            admin_id BIGINT PRIMARY KEY,
+            step TEXT NOT NULL,
+            data TEXT DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    '''),
+    (2, 'tournaments.start_message', '''
+        ALTER TABLE tournaments ADD COLUMN IF NOT EXISTS start_message TEXT;
+    '''),
+    (3, 'hot query indexes', '''
+        CREATE INDEX IF NOT EXISTS idx_users_balance
+            ON users (balance DESC);
+        CREATE INDEX IF NOT EXISTS idx_tournament_participants_refs
+            ON tournament_participants (tournament_id, refs_count DESC);
+        CREATE INDEX IF NOT EXISTS idx_tournaments_status_time
+            ON tournaments (status, start_time, end_time);
+        CREATE INDEX IF NOT EXISTS idx_user_trophies_user_date_id
+            ON user_trophies (user_id, date_received DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_user_states_updated_at
+            ON user_states (updated_at);
+        CREATE INDEX IF NOT EXISTS idx_pending_referrals_created_at
+            ON pending_referrals (created_at);
+    '''),
+    # Ключи нажатий — 64-битные хэши, партиции — по дню отправки сообщения: ключ нажатия
+    # всегда попадает в один и тот же день, поэтому (button_key, used_on) уникален так же,
+    # как button_key. Старую таблицу с текстовыми ключами не переносим: записи в ней живут сутки
+    (4, 'used_buttons with 64-bit keys, partitioned by day', '''
+        DROP TABLE IF EXISTS used_buttons;
+        CREATE TABLE used_buttons (
+            button_key BIGINT NOT NULL,
+            used_on DATE NOT NULL,
+            used_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (button_key, used_on)
+        ) PARTITION BY RANGE (used_on);
+        CREATE TABLE used_buttons_default PARTITION OF used_buttons DEFAULT;
+    '''),
+    # Активированные промокоды переезжают из массива users.used_promos в отдельную таблицу
+    (5, 'promo_redemptions', '''
+        CREATE TABLE IF NOT EXISTS promo_redemptions (
+            user_id BIGINT NOT NULL,
+            code TEXT NOT NULL,
+            redeemed_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, code)
+        );
+        INSERT INTO promo_redemptions (user_id, code)
+        SELECT u.user_id, UPPER(c.code)
+        FROM users u CROSS JOIN LATERAL unnest(u.used_promos) AS c(code)
+        WHERE c.code IS NOT NULL
+        ON CONFLICT (user_id, code) DO NOTHING;
+        ALTER TABLE users DROP COLUMN used_promos;
+    '''),
+    # Коды хранятся в верхнем регистре без пробелов, чтобы поиск шёл по первичному ключу.
+    # Из вариантов одного кода в разном регистре остаётся один
+    (6, 'normalized promo codes', '''
+        DELETE FROM promos a USING promos b
+        WHERE UPPER(TRIM(a.code)) = UPPER(TRIM(b.code)) AND a.code > b.code;
+        UPDATE promos SET code = UPPER(TRIM(code)) WHERE code <> UPPER(TRIM(code));
+        ALTER TABLE promos ADD CONSTRAINT promos_code_normalized CHECK (code = UPPER(TRIM(code)));
+    '''),
+    # Остаток промокода переезжает в слоты (по 16 на код, как PROMO_SLOTS по умолчанию);
+    # promos.uses теперь хранит выданный лимит
+    (7, 'promo_slots', '''
+        CREATE TABLE IF NOT EXISTS promo_slots (
+            code TEXT NOT NULL REFERENCES promos(code) ON DELETE CASCADE,
+            slot INTEGER NOT NULL,
+            uses INTEGER NOT NULL CHECK (uses >= 0),
+            PRIMARY KEY (code, slot)
+        );
+        INSERT INTO promo_slots (code, slot, uses)
+        SELECT p.code, g, GREATEST(p.uses, 0) / c.n + CASE WHEN g < GREATEST(p.uses, 0) % c.n THEN 1 ELSE 0 END
+        FROM promos p
+        CROSS JOIN LATERAL (SELECT GREATEST(LEAST(p.uses, 16), 1) AS n) c
+        CROSS JOIN LATERAL generate_series(0, c.n - 1) g
+        ON CONFLICT (code, slot) DO NOTHING;
+    '''),
+    # В частичном индексе только те, кому ещё не напоминали после последней награды
+    (8, 'bonus reminder cursor', '''
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS last_reminded_at BIGINT NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS idx_users_bonus_reminder
+            ON users (last_bonus, user_id)
+            WHERE last_reminded_at <= last_bonus AND last_bonus > 0;
+    '''),
+    # Номера сессий заменила эпоха кнопок в памяти; таблица с ними больше не нужна
+    (9, 'drop user_sessions', '''
+        DROP TABLE IF EXISTS user_sessions;
+    '''),
+]
+
+async def apply_migrations(conn) -> bool:
+    """Применяет недостающие шаги схемы одной транзакцией и режим хранения эфемерных таблиц.
+    Возвращает True, если что-то изменено"""
+    latest = MIGRATIONS[-1][0]
+    # Версия и режим хранения — одним запросом: на актуальной базе больше ничего не выполняется
+    persistence = 'u' if EPHEMERAL_TABLES_UNLOGGED else 'p'
+    try:
+        current, current_persistence = await conn.fetchrow('''
+            SELECT COALESCE(MAX(version), 0),
+                   (SELECT relpersistence::text FROM pg_class WHERE oid = to_regclass('user_states'))
+            FROM schema_version
+        ''')
+    except asyncpg.UndefinedTableError:
+        current, current_persistence = 0, None
+
+    if current >= latest:
+        if current_persistence == persistence:
+            print(f"[DB] Schema is up to date (version {current})")
+            return False
+        return await apply_ephemeral_storage_mode(conn)
+
+    async with conn.transaction():
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        # Второй экземпляр при одновременном деплое дождётся первого и ничего не повторит
+        await conn.execute('LOCK TABLE schema_version IN EXCLUSIVE MODE')
+        current = await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+
+        for version, description, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            await conn.execute(sql)
+            await conn.execute('INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                               version, description)
+            print(f"[DB] Migration {version} applied: {description}")
+
+    await apply_ephemeral_storage_mode(conn)
+    return True
+
+# Таблицы с одноразовыми данными, которые часто обновляются, и партиции used_buttons
+EPHEMERAL_TABLES = ['user_states', 'pending_referrals', 'admin_tournament_creation']
+
+async def apply_ephemeral_storage_mode(conn) -> bool:
+    """Приводит эфемерные таблицы к режиму EPHEMERAL_TABLES_UNLOGGED. Возвращает True, если что-то изменено"""
+    partitions = [row['relname'] for row in await sql_fetch(conn, 'list_button_partitions')]
+    persistence = 'u' if EPHEMERAL_TABLES_UNLOGGED else 'p'
+    fillfactor = f"fillfactor={EPHEMERAL_TABLES_FILLFACTOR}"
+
+    changed = False
+    for row in await sql_fetch(conn, 'get_table_storage', EPHEMERAL_TABLES + partitions):
+        name = row['relname']
+        if row['relpersistence'] != persistence:
+            # Перезаписывает таблицу целиком; на старте бота это дёшево
+            mode = 'UNLOGGED' if EPHEMERAL_TABLES_UNLOGGED else 'LOGGED'
+            await conn.execute(f'ALTER TABLE {name} SET {mode}')
+            changed = True
+        # Нажатия кнопок только вставляются — запас на странице им не нужен
+        if name in EPHEMERAL_TABLES and fillfactor not in (row['reloptions'] or []):
+            await conn.execute(f'ALTER TABLE {name} SET ({fillfactor})')
+            changed = True
+
+    if changed:
+        mode = 'unlogged' if EPHEMERAL_TABLES_UNLOGGED else 'logged'
+        print(f"[DB] Ephemeral tables switched to {mode} mode")
+    return changed
 
 async def init_db_pool():
-    global db_pool
+    global db_pool, background_pool, bulk_pool
     max_retries = 10
     retry_delay = 3
 
+    pools = [
+        DBPool('interactive', DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        DBPool('background', DB_BACKGROUND_POOL_MIN_SIZE, DB_BACKGROUND_POOL_MAX_SIZE),
+        DBPool('bulk', DB_BULK_POOL_MIN_SIZE, DB_BULK_POOL_MAX_SIZE),
+    ]
+
     for attempt in range(max_retries):
         try:
             print(f"[DB] Attempting connection {attempt + 1}/{max_retries}...")
-            db_pool = await asyncpg.create_pool(
-                DATABASE_URL,
-                min_size=5,
-                max_size=10,
-                command_timeout=60
-            )
-            print("[DB] Connection pool created successfully")
+            for pool in pools:
+                if pool.pool is None:
+                    await pool.open()
+            print("[DB] Connection pools created successfully")
             break
         except Exception as e:
             if attempt < max_retries - 1:
@@ -64,339 +919,353 @@ async def init_db_pool():
                 print(f"[DB] Failed to connect after {max_retries} attempts: {e}")
                 raise
 
-    # Создаём все необходимые таблицы
-    async with db_pool.acquire() as conn:
-        try:
-            # Таблица пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    username TEXT,
-                    balance DECIMAL(10, 2) DEFAULT 0,
-                    refs INTEGER DEFAULT 0,
-                    last_bonus BIGINT DEFAULT 0,
-                    used_promos TEXT[] DEFAULT ARRAY[]::TEXT[]
-                )
-            ''')
-
-            # Таблица состояний пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_states (
-                    user_id BIGINT PRIMARY KEY,
-                    state_data TEXT,
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица использованных кнопок
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS used_buttons (
-                    user_id BIGINT,
-                    button_id TEXT,
-                    used_at TIMESTAMP DEFAULT NOW(),
-                    PRIMARY KEY (user_id, button_id)
-                )
-            ''')
-
-            # Таблица ожидающих рефералов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS pending_referrals (
-                    user_id BIGINT PRIMARY KEY,
-                    referrer_id BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица сессий пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_sessions (
-                    user_id BIGINT PRIMARY KEY,
-                    session_count INTEGER DEFAULT 0,
-                    last_activity TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица промокодов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS promos (
-                    code TEXT PRIMARY KEY,
-                    reward DECIMAL(10, 2) NOT NULL,
-                    uses INTEGER DEFAULT 0
-                )
-            ''')
-
-            # Таблица турниров
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS tournaments (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    start_time BIGINT NOT NULL,
-                    end_time BIGINT NOT NULL,
-                    duration_days INTEGER NOT NULL,
-                    prize_places INTEGER NOT NULL,
-                    prizes JSONB NOT NULL,
-                    trophy_file_ids JSONB NOT NULL,
-                    status TEXT DEFAULT 'active',
-                    start_message TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица участников турнира
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS tournament_participants (
-                    tournament_id INTEGER REFERENCES tournaments(id) ON DELETE CASCADE,
-                    user_id BIGINT NOT NULL,
-                    refs_count INTEGER DEFAULT 0,
-                    PRIMARY KEY (tournament_id, user_id)
-                )
-            ''')
-
-            # Таблица наград пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_trophies (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    tournament_id INTEGER REFERENCES tournaments(id),
-                    tournament_name TEXT NOT NULL,
-                    place INTEGER NOT NULL,
-                    trophy_file_id TEXT NOT NULL,
-                    prize_stars DECIMAL(10, 2) NOT NULL,
-                    date_received BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица состояния создания турнира (для админа)
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS admin_tournament_creation (
-                    admin_id BIGINT PRIMARY KEY,
-                    step TEXT NOT NULL,
-                    data TEXT DEFAULT '{}',
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            print("[DB] All tables initialized successfully")
+    db_pool, background_pool, bulk_pool = pools
 
-            # Миграция: добавляем колонку start_message если её нет
-            try:
-                await conn.execute('''
-                    ALTER TABLE tournaments 
-                    ADD COLUMN IF NOT EXISTS start_message TEXT
-                ''')
-                print("[DB] Migration: start_message column ensured")
-            except Exception as migration_error:
-                print(f"[DB] Migration note: {migration_error}")
+    # Схема: на актуальной базе это одна проверка версии
+    async with db_connection() as conn:
+        applied = await apply_migrations(conn)
+        if applied:
+            # На свежей схеме партиций ещё нет; дальше их ведёт cleanup_task
+            await maintain_button_partitions(conn)
 
-        except Exception as e:
-            # If tables already exist, this is fine - just log and continue
-            print(f"[DB] Table initialization note: {e}")
-            print("[DB] Continuing with existing tables")
+    if applied:
+        # Пересоздаём соединения, чтобы init-хук подготовил запросы уже по новой схеме
+        for pool in (db_pool, background_pool, bulk_pool):
+            await pool.expire_connections()
 
 async def close_db_pool():
-    global db_pool
-    if db_pool:
-        await db_pool.close()
-        print("[DB] Connection pool closed")
+    for pool in (db_pool, background_pool, bulk_pool):
+        if pool:
+            await pool.close()
+    print("[DB] Connection pools closed")
+
+def state_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
 async def get_user_state(user_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT state_data FROM user_states WHERE user_id = $1',
-            user_id
-        )
-        return row['state_data'] if row else None
+    """Возвращает данные состояния (dict), имя состояния (str) или None"""
+    key = state_key(user_id)
+    data = await storage.get_data(key)
+    return data or await storage.get_state(key)
 
 async def set_user_state(user_id: int, state_data):
-    import json
-    async with db_pool.acquire() as conn:
-        # Если это уже строка, мы не пытаемся её сериализовать повторно
-        # Но для надежности проверяем, является ли она валидным JSON
-        if isinstance(state_data, dict):
-            state_data = json.dumps(state_data)
-        elif state_data is None:
-            state_data = None
-
-        await conn.execute(
-            '''INSERT INTO user_states (user_id, state_data, updated_at) 
-               VALUES ($1, $2, NOW())
-               ON CONFLICT (user_id) 
-               DO UPDATE SET state_data = $2, updated_at = NOW()''',
-            user_id, state_data
-        )
+    """Принимает имя состояния, словарь с необязательным ключом 'state' или None"""
+    key = state_key(user_id)
+    if isinstance(state_data, dict):
+        await storage.set_state(key, state_data.get('state'))
+        await storage.set_data(key, state_data)
+    else:
+        await storage.set_state(key, state_data)
+        await storage.set_data(key, {})
 
 async def delete_user_state(user_id: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            'DELETE FROM user_states WHERE user_id = $1',
-            user_id
-        )
+    await set_user_state(user_id, None)
+
+class CallbackDedup:
+    """Защита от повторных нажатий кнопок.
+
+    Ключ нажатия — 64-битный хэш (пользователь, сообщение, эпоха). Эпоха
+    пользователя меняется при каждом показе меню, после чего кнопки можно
+    нажать снова. Эпохи живут только в памяти: значения берутся из общего
+    счётчика, который начинается со случайного числа при старте процесса,
+    поэтому ключи не повторяются ни внутри процесса, ни после перезапуска.
+
+    Нажатия на сообщения этого процесса помнит только память: used хранит
+    ключи ttl секунд, не больше size. В used_buttons пишутся лишь нажатия на
+    сообщения, отправленные до старта, — их могли нажать и до перезапуска;
+    для них ключ берёт эпоху 0, пока пользователь не открыл меню в этом
+    процессе. После показа меню (menu_epochs) их снова можно нажать один
+    раз — эта эпоха до перезапуска не встречалась, так что хватает памяти.
+    """
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.started_at = time.time()
+        self.used = OrderedDict()
+        self.epochs = OrderedDict()
+        self.menu_epochs = OrderedDict()
+        self._next_epoch = random.getrandbits(62)
+
+    def _remember(self, epochs: OrderedDict, user_id: int, epoch: int):
+        epochs[user_id] = epoch
+        epochs.move_to_end(user_id)
+        while len(epochs) > self.size:
+            epochs.popitem(last=False)
+
+    def bump_epoch(self, user_id: int) -> int:
+        """Новая эпоха при показе меню: кнопки всех прежних сообщений снова можно нажать"""
+        self._next_epoch += 1
+        self._remember(self.epochs, user_id, self._next_epoch)
+        self._remember(self.menu_epochs, user_id, self._next_epoch)
+        return self._next_epoch
+
+    def epoch(self, user_id: int) -> int:
+        epoch = self.epochs.get(user_id)
+        if epoch is None:
+            # Пользователя вытеснили или он ещё не открывал меню. Сообщения до старта
+            # эта эпоха не разблокирует — для них она не считается показом меню
+            self._next_epoch += 1
+            epoch = self._next_epoch
+        self._remember(self.epochs, user_id, epoch)
+        return epoch
+
+    def key(self, user_id: int, message_id: int, epoch: int) -> int:
+        raw = struct.pack('>qqq', user_id, message_id, epoch)
+        return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'big', signed=True)
+
+    async def claim(self, user_id: int, message: types.Message) -> bool:
+        """True, если кнопку в этом сообщении нажали впервые в текущей эпохе"""
+        if message.date.timestamp() < self.started_at:
+            # Сообщение до старта: пока меню в этом процессе не показывали, эпоха 0 и ключ в БД
+            epoch = self.menu_epochs.get(user_id, 0)
+            persistent = epoch == 0
+        else:
+            epoch = self.epoch(user_id)
+            persistent = False
+        key = self.key(user_id, message.message_id, epoch)
+        now = time.time()
+
+        while self.used:
+            oldest, used_at = next(iter(self.used.items()))
+            if now - used_at < self.ttl and len(self.used) < self.size:
+                break
+            del self.used[oldest]
+
+        if key in self.used:
+            return False
+        self.used[key] = now
+        if not persistent:
+            return True
 
-async def is_button_used(user_id: int, button_id: str) -> bool:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            'SELECT EXISTS(SELECT 1 FROM used_buttons WHERE user_id = $1 AND button_id = $2)',
-            user_id, button_id
-        )
-        return result
+        # Одновременные нажатия после перезапуска разрешает первичный ключ used_buttons
+        async with db_connection() as conn:
+            return await sql_fetchval(conn, 'claim_button', key, message.date.date()) is not None
 
-async def mark_button_used(user_id: int, button_id: str):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO used_buttons (user_id, button_id, used_at) 
-               VALUES ($1, $2, NOW())
-               ON CONFLICT (user_id, button_id) DO NOTHING''',
-            user_id, button_id
-        )
+callback_dedup = CallbackDedup(CALLBACK_DEDUP_SIZE, 86400)
+
+def sign_bet_callback(user_id: int, action: str, bet: int) -> str:
+    """callback_data вида 'действие:ставка:подпись', подпись привязана к пользователю"""
+    payload = f"{action}:{bet}"
+    digest = hmac.new(CALLBACK_SECRET, f"{user_id}:{payload}".encode(), hashlib.sha256).digest()[:8]
+    return f"{payload}:{base64.urlsafe_b64encode(digest).decode().rstrip('=')}"
+
+def verify_bet_callback(user_id: int, data: str):
+    """Возвращает (действие, ставка). Ставка None, если её нет или подпись не сошлась"""
+    parts = data.split(':')
+    if len(parts) != 3:
+        return data, None
+    action, bet, _ = parts
+    try:
+        if hmac.compare_digest(sign_bet_callback(user_id, action, int(bet)), data):
+            return action, int(bet)
+    except ValueError:
+        pass
+    return action, None
 
 async def get_pending_referral(user_id: int):
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            'SELECT referrer_id FROM pending_referrals WHERE user_id = $1',
-            user_id
-        )
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        return ctx['pending_referrer']
+    async with db_connection() as conn:
+        result = await sql_fetchval(conn, 'get_pending_referral', user_id)
         return result
 
 async def set_pending_referral(user_id: int, referrer_id: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO pending_referrals (user_id, referrer_id, created_at) 
-               VALUES ($1, $2, NOW())
-               ON CONFLICT (user_id) 
-               DO UPDATE SET referrer_id = $2, created_at = NOW()''',
-            user_id, referrer_id
-        )
+    async with db_connection() as conn:
+        await sql_execute(conn, 'set_pending_referral', user_id, referrer_id)
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        ctx['pending_referrer'] = referrer_id
 
 async def delete_pending_referral(user_id: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            'DELETE FROM pending_referrals WHERE user_id = $1',
-            user_id
-        )
-
-async def get_user_session(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            'SELECT session_count FROM user_sessions WHERE user_id = $1',
-            user_id
-        )
-        return result if result is not None else 0
-
-async def increment_user_session(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            '''INSERT INTO user_sessions (user_id, session_count, last_activity) 
-               VALUES ($1, 1, NOW())
-               ON CONFLICT (user_id) 
-               DO UPDATE SET session_count = user_sessions.session_count + 1, last_activity = NOW()
-               RETURNING session_count''',
-            user_id
-        )
-        return result
+    async with db_connection() as conn:
+        await sql_execute(conn, 'delete_pending_referral', user_id)
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        ctx['pending_referrer'] = None
+
+async def maintain_button_partitions(conn):
+    """Создаёт дневные партиции used_buttons наперёд и удаляет устаревшие целиком"""
+    import datetime
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    existing = {row['relname'] for row in await sql_fetch(conn, 'list_button_partitions')}
+
+    dropped = 0
+    for name in existing:
+        if not name.startswith('used_buttons_p'):
+            continue
+        day = datetime.datetime.strptime(name[len('used_buttons_p'):], '%Y%m%d').date()
+        if day < today - datetime.timedelta(days=BUTTON_PARTITION_RETENTION_DAYS):
+            await conn.execute(f'DROP TABLE {name}')
+            dropped += 1
+
+    days = [today + datetime.timedelta(days=offset) for offset in range(-1, BUTTON_PARTITION_AHEAD_DAYS + 1)]
+    missing = [day for day in days if f"used_buttons_p{day:%Y%m%d}" not in existing]
+
+    # Партиция не создаётся, пока в default есть строки за её день. Такие строки переносим
+    # во временную таблицу, а после создания партиции — в неё: иначе кнопку можно было бы
+    # нажать второй раз. В default остаются нажатия за дни без партиций; удаляем только те,
+    # что старше срока хранения, как и сами партиции
+    cutoff = today - datetime.timedelta(days=BUTTON_PARTITION_RETENTION_DAYS)
+    async with conn.transaction():
+        if missing:
+            await conn.execute('CREATE TEMP TABLE used_buttons_moved (LIKE used_buttons) ON COMMIT DROP')
+            await conn.execute(
+                'INSERT INTO used_buttons_moved SELECT * FROM used_buttons_default WHERE used_on = ANY($1::date[])',
+                missing
+            )
+            await conn.execute('DELETE FROM used_buttons_default WHERE used_on = ANY($1::date[])', missing)
+            for day in missing:
+                await conn.execute(
+                    f"CREATE {'UNLOGGED ' if EPHEMERAL_TABLES_UNLOGGED else ''}TABLE used_buttons_p{day:%Y%m%d} "
+                    f"PARTITION OF used_buttons "
+                    f"FOR VALUES FROM ('{day}') TO ('{day + datetime.timedelta(days=1)}')"
+                )
+            await conn.execute('INSERT INTO used_buttons SELECT * FROM used_buttons_moved ON CONFLICT DO NOTHING')
+        await conn.execute('DELETE FROM used_buttons_default WHERE used_on < $1', cutoff)
+    return dropped
 
 async def cleanup_old_records():
-    async with db_pool.acquire() as conn:
-        deleted_buttons = await conn.execute(
-            "DELETE FROM used_buttons WHERE used_at < NOW() - INTERVAL '24 hours'"
-        )
-        deleted_states = await conn.execute(
-            "DELETE FROM user_states WHERE updated_at < NOW() - INTERVAL '24 hours'"
-        )
-        deleted_refs = await conn.execute(
-            "DELETE FROM pending_referrals WHERE created_at < NOW() - INTERVAL '24 hours'"
-        )
-        print(f"[CLEANUP] Deleted old records: buttons={deleted_buttons}, states={deleted_states}, referrals={deleted_refs}")
+    async with background_pool.acquire() as conn:
+        dropped_partitions = await maintain_button_partitions(conn)
+        deleted_refs = await sql_execute(conn, 'cleanup_pending_referrals')
+        print(f"[CLEANUP] Deleted old records: button partitions={dropped_partitions}, referrals={deleted_refs}")
+
+def user_from_row(row):
+    return {
+        'user_id': row['user_id'],
+        'name': row['name'],
+        'username': row['username'],
+        'balance': float(row['balance']),
+        'refs': row['refs'],
+        'last_bonus': row['last_bonus']
+    }
+
+# Контекст пользователя текущего апдейта: строка users, ожидающий реферал и флаг создания.
+# Заполняется одним запросом в middleware, хелперы ниже читают из него вместо БД
+user_context = contextvars.ContextVar('user_context', default=None)
+
+def get_user_context(user_id: int):
+    ctx = user_context.get()
+    return ctx if ctx is not None and ctx['user_id'] == user_id else None
+
+async def load_user_context(user: types.User, create: bool) -> dict:
+    """Читает пользователя, его состояние и ожидающий реферал одним запросом,
+    при create=True заодно создаёт строку в users"""
+    async with db_connection() as conn:
+        row = await sql_fetchrow(conn, 'load_user_context', user.id, user.first_name or 'Пользователь',
+                                 user.username or '', create, float(storage.ttl))
+    if row['created']:
+        print(f"[USER] Created new user {user.id}: {user.first_name}")
+    storage.prime(user.id, row['state_data'], row['state_age'])
+    return {
+        'user_id': user.id,
+        'user': user_from_row(row) if row['user_id'] is not None else None,
+        'created': row['created'],
+        'pending_referrer': row['referrer_id'],
+    }
+
+def note_user_balance(user_id: int, balance: float):
+    """Сообщает об изменении баланса топу и сбрасывает устаревшую строку из контекста"""
+    top_users_cache.note_balance(user_id, balance)
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        ctx['user'] = None
 
 async def get_user(user_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT user_id, name, username, balance, refs, last_bonus, used_promos FROM users WHERE user_id = $1',
-            user_id
-        )
-        if row:
-            return {
-                'user_id': row['user_id'],
-                'name': row['name'],
-                'username': row['username'],
-                'balance': float(row['balance']),
-                'refs': row['refs'],
-                'last_bonus': row['last_bonus'],
-                'used_promos': row['used_promos'] or []
-            }
-        return None
+    ctx = get_user_context(user_id)
+    if ctx is not None and ctx['user'] is not None:
+        return dict(ctx['user'])
+    async with db_connection() as conn:
+        row = await sql_fetchrow(conn, 'get_user', user_id)
+        user = user_from_row(row) if row else None
+    if ctx is not None:
+        ctx['user'] = user
+    return dict(user) if user else None
 
 async def create_user(user_id: int, name: str, username: str = ''):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO users (user_id, name, username, balance, refs, last_bonus, used_promos) 
-               VALUES ($1, $2, $3, 0, 0, 0, ARRAY[]::TEXT[])
-               ON CONFLICT (user_id) DO NOTHING''',
-            user_id, name, username
-        )
+    async with db_connection() as conn:
+        await sql_execute(conn, 'create_user', user_id, name, username)
         print(f"[USER] Created new user {user_id}: {name}")
 
 async def update_user_balance(user_id: int, delta: float):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
-            Decimal(str(delta)), user_id
-        )
+    async with db_connection() as conn:
+        balance = await sql_fetchval(conn, 'update_user_balance', Decimal(str(delta)), user_id)
+        if balance is not None:
+            note_user_balance(user_id, float(balance))
 
 async def get_user_balance(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
-        balance = await conn.fetchval(
-            'SELECT balance FROM users WHERE user_id = $1',
-            user_id
-        )
+    ctx = get_user_context(user_id)
+    if ctx is not None and ctx['user'] is not None:
+        return ctx['user']['balance']
+    async with db_connection() as conn:
+        balance = await sql_fetchval(conn, 'get_user_balance', user_id)
         return float(balance) if balance is not None else 0
 
-async def update_daily_bonus(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            row = await conn.fetchrow(
-                'SELECT last_bonus FROM users WHERE user_id = $1 FOR UPDATE',
-                user_id
-            )
-            if not row:
-                return False
+async def settle_bet(user_id: int, bet: float, win: float):
+    """Списывает ставку и начисляет выигрыш одним запросом.
+    Возвращает новый баланс или None, если средств на ставку не хватает"""
+    async with db_connection() as conn:
+        balance = await sql_fetchval(conn, 'settle_bet', Decimal(str(bet)), Decimal(str(win)), user_id)
+        if balance is None:
+            return None
+        note_user_balance(user_id, float(balance))
+        return float(balance)
+
+async def pay_win(user_id: int, win: float, balance: float) -> float:
+    """Начисляет выигрыш сразу после броска; ставка к этому моменту уже списана через settle_bet(bet, 0).
+    Возвращает новый баланс, а если строки пользователя нет — переданный"""
+    if not win:
+        return balance
+    async with db_connection() as conn:
+        new_balance = await sql_fetchval(conn, 'update_user_balance', Decimal(str(win)), user_id)
+    if new_balance is None:
+        print(f"[GAME] ERROR: User {user_id} not found, win {win} not credited")
+        return balance
+    note_user_balance(user_id, float(new_balance))
+    return float(new_balance)
 
-            now = time.time()
-            if now - row['last_bonus'] >= 86400:
-                await conn.execute(
-                    'UPDATE users SET balance = balance + 0.2, last_bonus = $1 WHERE user_id = $2',
-                    now, user_id
-                )
-                return True
+async def update_daily_bonus(user_id: int) -> bool:
+    async with db_connection() as conn:
+        now = int(time.time())
+        # Проверка и начисление в одном запросе: строка блокируется только на время UPDATE
+        balance = await sql_fetchval(conn, 'update_daily_bonus', now, user_id, now - 86400)
+        if balance is None:
             return False
+        note_user_balance(user_id, float(balance))
+        return True
 
 async def process_referral_db(user_id: int, ref_id: int, user_name: str):
     try:
         print(f"[REFERRAL] Processing referral: user {user_id} referred by {ref_id}")
 
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                referrer = await conn.fetchrow(
-                    'SELECT user_id, balance, refs FROM users WHERE user_id = $1 FOR UPDATE',
-                    ref_id
-                )
+        # Турнир берём до транзакции: промах кэша ждёт его блокировку и второе соединение,
+        # а внутри транзакции мы бы при этом держали соединение и строку реферера
+        active_tournament = await get_active_tournament()
+        tournament_id = active_tournament['id'] if active_tournament else None
 
-                if not referrer:
-                    print(f"[REFERRAL] ERROR: Referrer {ref_id} not found in users")
-                    return
+        # Начисление и турнирный счётчик — одна транзакция на соединении апдейта
+        async with db_transaction() as conn:
+            referrer = await sql_fetchrow(conn, 'lock_referrer', ref_id)
 
-                await conn.execute(
-                    'UPDATE users SET balance = balance + 2, refs = refs + 1 WHERE user_id = $1',
-                    ref_id
-                )
-                print(f"[REFERRAL] Added 2 stars to referrer {ref_id}")
+            if not referrer:
+                print(f"[REFERRAL] ERROR: Referrer {ref_id} not found in users")
+                return
 
-        # Проверяем активный турнир и увеличиваем счетчик
-        active_tournament = await get_active_tournament()
-        if active_tournament:
-            await increment_tournament_refs(active_tournament['id'], ref_id)
-            print(f"[TOURNAMENT] Added 1 ref to user {ref_id} in tournament {active_tournament['id']}")
+            balance = await sql_fetchval(conn, 'credit_referrer', ref_id)
+            print(f"[REFERRAL] Added 2 stars to referrer {ref_id}")
+
+            # Увеличиваем счетчик в активном турнире
+            refs_count = None
+            if tournament_id is not None:
+                refs_count = await increment_tournament_refs(tournament_id, ref_id)
+                print(f"[TOURNAMENT] Added 1 ref to user {ref_id} in tournament {tournament_id}")
+
+        # Кэши обновляем только после фиксации транзакции
+        note_user_balance(ref_id, float(balance))
+        if refs_count is not None:
+            note_tournament_refs(tournament_id, ref_id, refs_count)
 
         try:
             await bot.send_message(
@@ -410,87 +1279,168 @@ async def process_referral_db(user_id: int, ref_id: int, user_name: str):
     except Exception as e:
         print(f"[REFERRAL] ERROR: Failed to process referral: {e}")
 
-async def get_promo(code: str):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT code, reward, uses FROM promos WHERE code = $1',
-            code
-        )
-        if row:
-            return {
-                'code': row['code'],
-                'reward': float(row['reward']),
-                'uses': row['uses']
-            }
-        return None
+def normalize_promo_code(code: str) -> str:
+    return code.strip().upper()
+
+class PromoCache:
+    """Промокоды в памяти процесса.
+
+    Таблица promos маленькая, поэтому держим её целиком: codes: код ->
+    [награда, осталось использований]. Кода нет в снимке — значит, он
+    неверный, и перебор вариантов до Postgres не доходит. Снимок
+    перечитывается раз в ttl секунд; /addpromo и активации обновляют его сразу.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.codes = {}
+        self.loaded_at = 0
+        self.version = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, code: str):
+        if time.time() - self.loaded_at >= self.ttl:
+            await self.reload()
+        return self.codes.get(code)
+
+    async def reload(self):
+        async with self._lock:
+            if time.time() - self.loaded_at < self.ttl:
+                return
+            version = self.version
+            async with db_connection() as conn:
+                rows = await sql_fetch(conn, 'list_promos')
+            codes = {row['code']: [float(row['reward']), row['uses']] for row in rows}
+            # Если код изменили во время загрузки, снимок устарел — перечитаем при следующем запросе
+            if version == self.version:
+                self.codes = codes
+                self.loaded_at = time.time()
+
+    def set(self, code: str, reward: float, uses: int):
+        self.version += 1
+        self.codes[code] = [reward, uses]
+
+    def set_uses(self, code: str, uses):
+        self.version += 1
+        if uses is None:
+            self.codes.pop(code, None)
+        elif code in self.codes:
+            self.codes[code][1] = uses
+
+promo_cache = PromoCache(PROMO_CACHE_TTL)
+
+async def save_promo(conn, code: str, reward: float, uses: int):
+    """Создаёт или перезаписывает промокод и раскладывает остаток по слотам"""
+    async with conn.transaction():
+        await sql_execute(conn, 'upsert_promo', code, reward, uses)
+        await sql_execute(conn, 'upsert_promo_slots', code, uses, PROMO_SLOTS)
+        await sql_execute(conn, 'trim_promo_slots', code, uses, PROMO_SLOTS)
+    promo_cache.set(code, reward, uses)
 
 async def use_promo(user_id: int, code: str):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            user = await conn.fetchrow(
-                'SELECT used_promos FROM users WHERE user_id = $1 FOR UPDATE',
-                user_id
-            )
-            if not user:
+    code = normalize_promo_code(code)
+    entry = await promo_cache.get(code)
+    if entry is None:
+        return {'success': False, 'message': '❌ Неверный промокод'}
+    if entry[1] <= 0:
+        return {'success': False, 'message': '❌ Промокод исчерпан'}
+
+    start = random.randrange(PROMO_SLOTS)
+    async with db_connection() as conn:
+        # Захватываем свободный слот, записываем активацию, списываем использование
+        # и начисляем награду — всё одним запросом
+        row = await sql_fetchrow(conn, 'use_promo', code, user_id, start)
+        # Все непустые слоты заняты — ждём один из них, пока остаток не кончится
+        while (row['reward'] is None and not row['got_slot'] and row['user_exists']
+               and row['not_used'] and row['uses']):
+            row = await sql_fetchrow(conn, 'use_promo_wait', code, user_id, start)
+        promo_cache.set_uses(code, row['uses'])
+
+        if row['reward'] is None:
+            if not row['user_exists']:
                 return {'success': False, 'message': '❌ Пользователь не найден'}
-
-            if code in (user['used_promos'] or []):
+            if not row['not_used']:
                 return {'success': False, 'message': '❌ Вы уже активировали этот промокод'}
-
-            promo = await conn.fetchrow(
-                'SELECT reward, uses FROM promos WHERE UPPER(code) = UPPER($1) FOR UPDATE',
-                code
-            )
-
-            if not promo:
+            if row['uses'] is None:
                 return {'success': False, 'message': '❌ Неверный промокод'}
+            return {'success': False, 'message': '❌ Промокод исчерпан'}
+
+        reward = float(row['reward'])
+        note_user_balance(user_id, float(row['balance']))
+        return {
+            'success': True,
+            'message': f'✅ Промокод {code} активирован — +{reward} ⭐️'
+        }
+
+class TopUsersCache:
+    """Топ пользователей по балансу в памяти процесса.
+
+    Держит size лучших пользователей и порог floor: ни у кого вне кэша баланс
+    не выше него. Хелперы, меняющие баланс, сообщают новый баланс через
+    note_balance(). Если в топ поднимается пользователь не из кэша, кэш
+    помечается устаревшим и перечитывается при следующем запросе; не реже
+    раза в ttl секунд он перечитывается в любом случае.
+    """
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.entries = {}
+        self.floor = None
+        self.loaded_at = 0.0
+        self.stale = True
+        self._lock = asyncio.Lock()
+
+    def _needs_reload(self, limit: int) -> bool:
+        if self.stale or time.monotonic() - self.loaded_at > self.ttl:
+            return True
+        # После вылета пользователей из кэша в нём может не хватить записей
+        return self.floor is not None and len(self.entries) < limit
+
+    async def get(self, limit: int):
+        if limit > self.size:
+            return await load_top_users(limit)
+
+        if self._needs_reload(limit):
+            async with self._lock:
+                if self._needs_reload(limit):
+                    rows = await load_top_users(self.size)
+                    self.entries = {row['user_id']: row for row in rows}
+                    self.floor = rows[-1]['balance'] if len(rows) == self.size else None
+                    self.loaded_at = time.monotonic()
+                    self.stale = False
+
+        top = sorted(self.entries.values(), key=lambda entry: entry['balance'], reverse=True)[:limit]
+        return [{'name': entry['name'], 'balance': entry['balance']} for entry in top]
+
+    def note_balance(self, user_id: int, balance: float):
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            if self.floor is not None and balance < self.floor:
+                # Кто-то вне кэша может оказаться выше — убираем пользователя из топа
+                del self.entries[user_id]
+            else:
+                entry['balance'] = balance
+        elif self.floor is None or balance > self.floor:
+            self.stale = True
 
-            if promo['uses'] <= 0:
-                return {'success': False, 'message': '❌ Промокод исчерпан'}
-
-            reward = float(promo['reward'])
-
-            await conn.execute(
-                '''UPDATE users 
-                   SET balance = balance + $1, 
-                       used_promos = array_append(used_promos, $2)
-                   WHERE user_id = $3''',
-                Decimal(str(reward)), code, user_id
-            )
-
-            await conn.execute(
-                'UPDATE promos SET uses = uses - 1 WHERE code = $1',
-                code
-            )
+top_users_cache = TopUsersCache(TOP_CACHE_SIZE, TOP_CACHE_TTL)
 
-            return {
-                'success': True,
-                'message': f'✅ Промокод {code} активирован — +{reward} ⭐️'
-            }
+async def load_top_users(limit: int):
+    async with db_connection() as conn:
+        rows = await sql_fetch(conn, 'get_top_users', limit)
+        return [{'user_id': row['user_id'], 'name': row['name'], 'balance': float(row['balance'])} for row in rows]
 
 async def get_top_users(limit: int = 10):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            'SELECT user_id, name, balance FROM users ORDER BY balance DESC LIMIT $1',
-            limit
-        )
-        return [{'name': row['name'], 'balance': float(row['balance'])} for row in rows]
+    return await top_users_cache.get(limit)
 
 async def withdraw_balance(user_id: int, amount: float):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            balance = await conn.fetchval(
-                'SELECT balance FROM users WHERE user_id = $1 FOR UPDATE',
-                user_id
-            )
-            if not balance or float(balance) < amount:
-                return False
-
-            await conn.execute(
-                'UPDATE users SET balance = balance - $1 WHERE user_id = $2',
-                Decimal(str(amount)), user_id
-            )
-            return True
+    async with db_connection() as conn:
+        balance = await sql_fetchval(conn, 'withdraw_balance', Decimal(str(amount)), user_id)
+        if balance is None:
+            return False
+        note_user_balance(user_id, float(balance))
+        return True
 
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
@@ -500,7 +1450,7 @@ def is_admin(user_id: int) -> bool:
 async def create_tournament(name: str, start_time: int, duration_days: int, 
                            prize_places: int, prizes: dict, trophy_file_ids: dict, start_message: str = None):
     """Создает новый турнир"""
-    async with db_pool.acquire() as conn:
+    async with db_connection() as conn:
         end_time = start_time + (duration_days * 86400)
 
         # Конвертируем словари в JSONB совместимый формат
@@ -508,28 +1458,147 @@ async def create_tournament(name: str, start_time: int, duration_days: int,
         prizes_json = json.dumps(prizes)
         trophy_file_ids_json = json.dumps(trophy_file_ids)
 
-        tournament_id = await conn.fetchval(
-            '''INSERT INTO tournaments 
-               (name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status, start_message)
-               VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7::jsonb, 'active', $8)
-               RETURNING id''',
+        tournament_id = await sql_fetchval(conn, 'create_tournament',
             name, start_time, end_time, duration_days, prize_places, 
             prizes_json, trophy_file_ids_json, start_message
         )
-        return tournament_id
+
+    active_tournament_cache.invalidate()
+    return tournament_id
+
+class ActiveTournamentCache:
+    """Текущий активный турнир в памяти процесса.
+
+    Кэш действует до ближайшей границы: конца текущего турнира или начала
+    следующего запланированного. Создание и завершение турниров сбрасывают
+    его через invalidate().
+    """
+
+    def __init__(self):
+        self.tournament = None
+        self.valid_until = 0
+        self.version = 0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+        self.valid_until = 0
+
+    async def get(self):
+        if time.time() < self.valid_until:
+            return self.tournament
+
+        async with self._lock:
+            now = int(time.time())
+            if now < self.valid_until:
+                return self.tournament
+
+            version = self.version
+            tournament, next_start = await load_active_tournament(now)
+            boundaries = [t for t in (next_start, tournament and tournament['end_time']) if t]
+            self.tournament = tournament
+            # Если кэш сбросили во время загрузки, следующий запрос перечитает турнир
+            if version == self.version:
+                self.valid_until = min(boundaries) if boundaries else float('inf')
+            return tournament
+
+active_tournament_cache = ActiveTournamentCache()
 
 async def get_active_tournament():
     """Получает активный турнир"""
+    return await active_tournament_cache.get()
+
+class TournamentPageCache:
+    """Страницы списка турниров и готовые карточки в памяти процесса.
+
+    pages: номер -> [турнир, всего турниров, действует до, версия].
+    Страница живёт до ближайшего конца среди активных турниров, но не дольше
+    ttl, и сбрасывается вместе с active_tournament_cache. Карточки хранятся
+    по (id, часов до конца): между ними меняется только строка «Осталось».
+    """
+
+    def __init__(self, ttl: int, size: int = 256):
+        self.ttl = ttl
+        self.size = size
+        self.pages = {}
+        self.cards = OrderedDict()
+
+    async def page(self, page: int, now: int):
+        """Возвращает (турнир, всего турниров) или (None, 0); номер вне списка даёт первую страницу"""
+        entry = self.pages.get(page)
+        if entry and now < entry[2] and entry[3] == active_tournament_cache.version:
+            return entry[0], entry[1]
+
+        version = active_tournament_cache.version
+        async with db_connection() as conn:
+            row = await sql_fetchrow(conn, 'get_active_tournament_page', now, page)
+            if row is None and page > 0:
+                page = 0
+                row = await sql_fetchrow(conn, 'get_active_tournament_page', now, 0)
+        if row is None:
+            return None, 0
+
+        tournament = dict(row)
+        self.pages[page] = [tournament, row['total'], min(row['first_end'], now + self.ttl), version]
+        return tournament, row['total']
+
+    def card(self, t: dict, now: int) -> str:
+        key = (t['id'], (t['end_time'] - now) // 3600)
+        text = self.cards.get(key)
+        if text is None:
+            text = render_tournament_card(t, now)
+            self.cards[key] = text
+            while len(self.cards) > self.size:
+                self.cards.popitem(last=False)
+        return text
+
+tournament_pages = TournamentPageCache(TOURNAMENT_PAGE_TTL)
+
+def render_tournament_card(t: dict, now: int) -> str:
     import json
-    async with db_pool.acquire() as conn:
-        now = int(time.time())
-        row = await conn.fetchrow(
-            '''SELECT id, name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status
-               FROM tournaments 
-               WHERE status = 'active' AND start_time <= $1 AND end_time > $1
-               ORDER BY id DESC LIMIT 1''',
-            now
-        )
+    import datetime
+    start_dt = datetime.datetime.fromtimestamp(t['start_time'], MOSCOW_TZ)
+    end_dt = datetime.datetime.fromtimestamp(t['end_time'], MOSCOW_TZ)
+
+    # Парсим prizes если это строка
+    prizes = t['prizes']
+    if isinstance(prizes, str):
+        prizes = json.loads(prizes)
+
+    # Определяем статус
+    if t['start_time'] > now:
+        status_emoji = "🔜"
+        status_text = "Скоро начнется"
+        time_info = f"⏰ Начало: {start_dt.strftime('%d.%m.%Y %H:%M')}"
+    else:
+        status_emoji = "🔥"
+        status_text = "Активен"
+        time_left = t['end_time'] - now
+        days_left = time_left // 86400
+        hours_left = (time_left % 86400) // 3600
+        time_info = f"⏰ Осталось: {days_left}д {hours_left}ч"
+
+    # Призы
+    prizes_text = "\n".join([
+        f"{'🥇' if int(p) == 1 else '🥈' if int(p) == 2 else '🥉' if int(p) == 3 else '🏅'} {p} место: {v}⭐️"
+        for p, v in prizes.items()
+    ])
+
+    return (
+        f"{status_emoji} <b>{t['name']}</b>\n\n"
+        f"📊 Статус: {status_text}\n"
+        f"{time_info}\n"
+        f"📅 Конец: {end_dt.strftime('%d.%m.%Y %H:%M')}\n"
+        f"🏆 Призовых мест: {t['prize_places']}\n\n"
+        f"<b>💰 Призы:</b>\n{prizes_text}\n\n"
+        f"💡 Приглашай друзей, чтобы выиграть!"
+    )
+
+async def load_active_tournament(now: int):
+    import json
+    async with db_connection() as conn:
+        row = await sql_fetchrow(conn, 'get_active_tournament', now)
+        next_start = await sql_fetchval(conn, 'get_next_tournament_start', now)
         if row:
             # Парсим JSON поля если они строки
             prizes = row['prizes']
@@ -550,80 +1619,163 @@ async def get_active_tournament():
                 'prizes': prizes,
                 'trophy_file_ids': trophy_file_ids,
                 'status': row['status']
-            }
-        return None
+            }, next_start
+        return None, next_start
+
+class TournamentRankIndex:
+    """Рейтинг участников одного турнира в памяти процесса.
+
+    keys — отсортированный список (-refs_count, user_id), поэтому первые
+    элементы — лидеры, а позиция пользователя ищется бинарным поиском.
+    Загружается из БД один раз и дальше обновляется note_tournament_refs().
+    """
+
+    def __init__(self, tournament_id: int):
+        self.tournament_id = tournament_id
+        self.refs = {}
+        self.keys = []
+        self.loaded = False
+        self._lock = asyncio.Lock()
+
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        async with self._lock:
+            if self.loaded:
+                return
+            async with db_connection() as conn:
+                rows = await sql_fetch(conn, 'get_tournament_ref_counts', self.tournament_id)
+            # Пока шла загрузка, set() мог записать более свежие значения — счётчики только растут
+            for row in rows:
+                self.refs[row['user_id']] = max(row['refs_count'] or 0, self.refs.get(row['user_id'], 0))
+            self.keys = sorted((-refs, user_id) for user_id, refs in self.refs.items())
+            self.loaded = True
+
+    def set(self, user_id: int, refs_count: int):
+        old = self.refs.get(user_id)
+        if old is not None:
+            idx = bisect.bisect_left(self.keys, (-old, user_id))
+            if idx < len(self.keys) and self.keys[idx] == (-old, user_id):
+                del self.keys[idx]
+        self.refs[user_id] = refs_count
+        bisect.insort(self.keys, (-refs_count, user_id))
+
+    def position(self, user_id: int):
+        """Место как в COUNT(*) + 1: число участников со строго большим счётом плюс один"""
+        refs_count = self.refs.get(user_id, 0)
+        return {'position': bisect.bisect_left(self.keys, (-refs_count,)) + 1, 'refs_count': refs_count}
+
+    def top(self, limit: int):
+        return [(user_id, -neg_refs) for neg_refs, user_id in self.keys[:limit]]
+
+    def around(self, user_id: int, radius: int = 2):
+        refs_count = self.refs.get(user_id, 0)
+        idx = bisect.bisect_left(self.keys, (-refs_count, user_id))
+        start = max(idx - radius, 0)
+        return [(bisect.bisect_left(self.keys, (neg_refs,)) + 1, uid, -neg_refs)
+                for neg_refs, uid in self.keys[start:idx + radius + 1]]
+
+class TournamentRankCache:
+    """Индексы мест по турнирам.
+
+    Индекс текущего активного турнира держится до его завершения и
+    обновляется по мере начисления рефералов. Остальные турниры (завершённые,
+    другие страницы списка, любой id из кнопки) не меняются и лежат в LRU
+    на size записей, чтобы память не росла от каждого открытого рейтинга.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.active = None
+        self.recent = OrderedDict()
+
+    def _activate(self, tournament_id: int) -> TournamentRankIndex:
+        if self.active is None or self.active.tournament_id != tournament_id:
+            self.active = self.recent.pop(tournament_id, None) or TournamentRankIndex(tournament_id)
+        return self.active
+
+    async def get(self, tournament_id: int) -> TournamentRankIndex:
+        active = await get_active_tournament()
+        if active and active['id'] == tournament_id:
+            index = self._activate(tournament_id)
+        else:
+            index = self.recent.get(tournament_id)
+            if index is None:
+                index = self.recent[tournament_id] = TournamentRankIndex(tournament_id)
+                while len(self.recent) > self.size:
+                    self.recent.popitem(last=False)
+            else:
+                self.recent.move_to_end(tournament_id)
+        await index.ensure_loaded()
+        return index
 
-async def add_tournament_participant(tournament_id: int, user_id: int):
-    """Добавляет участника в турнир"""
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
-               VALUES ($1, $2, 0)
-               ON CONFLICT (tournament_id, user_id) DO NOTHING''',
-            tournament_id, user_id
-        )
+    def note(self, tournament_id: int, user_id: int, refs_count: int):
+        """Рефералы начисляются только в текущем активном турнире"""
+        self._activate(tournament_id).set(user_id, refs_count)
 
-async def increment_tournament_refs(tournament_id: int, user_id: int):
-    """Увеличивает счетчик рефералов участника в турнире"""
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
-               VALUES ($1, $2, 1)
-               ON CONFLICT (tournament_id, user_id) 
-               DO UPDATE SET refs_count = tournament_participants.refs_count + 1''',
-            tournament_id, user_id
-        )
+    def forget(self, tournament_id: int):
+        if self.active is not None and self.active.tournament_id == tournament_id:
+            self.active = None
+        self.recent.pop(tournament_id, None)
+
+tournament_ranks = TournamentRankCache(TOURNAMENT_RANK_CACHE_SIZE)
+
+async def get_tournament_ranks(tournament_id: int) -> TournamentRankIndex:
+    return await tournament_ranks.get(tournament_id)
+
+async def increment_tournament_refs(tournament_id: int, user_id: int) -> int:
+    """Увеличивает счетчик рефералов участника в турнире (участник появляется с первым рефералом).
+
+    Индекс мест не трогает: вызывающий передаёт результат в note_tournament_refs() после фиксации.
+    """
+    async with db_connection() as conn:
+        return await sql_fetchval(conn, 'increment_tournament_refs', tournament_id, user_id)
+
+def note_tournament_refs(tournament_id: int, user_id: int, refs_count: int):
+    tournament_ranks.note(tournament_id, user_id, refs_count)
 
 async def get_tournament_leaderboard(tournament_id: int, limit: int = 10):
     """Получает таблицу лидеров турнира"""
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''SELECT tp.user_id, u.name, u.username, tp.refs_count
-               FROM tournament_participants tp
-               JOIN users u ON tp.user_id = u.user_id
-               WHERE tp.tournament_id = $1
-               ORDER BY tp.refs_count DESC
-               LIMIT $2''',
-            tournament_id, limit
-        )
-        return [{'user_id': row['user_id'], 'name': row['name'], 
-                 'username': row['username'], 'refs_count': row['refs_count']} 
-                for row in rows]
+    index = await get_tournament_ranks(tournament_id)
+    top = index.top(limit)
+    if not top:
+        return []
+    async with db_connection() as conn:
+        rows = await sql_fetch(conn, 'get_user_names', [user_id for user_id, _ in top])
+    names = {row['user_id']: row for row in rows}
+    return [{'user_id': user_id, 'name': names[user_id]['name'],
+             'username': names[user_id]['username'], 'refs_count': refs_count}
+            for user_id, refs_count in top if user_id in names]
+
+async def get_tournament_neighbours(tournament_id: int, user_id: int, radius: int = 2):
+    """Получает участников вокруг пользователя в рейтинге турнира"""
+    index = await get_tournament_ranks(tournament_id)
+    nearby = index.around(user_id, radius)
+    async with db_connection() as conn:
+        rows = await sql_fetch(conn, 'get_user_names', [uid for _, uid, _ in nearby])
+    names = {row['user_id']: row['name'] for row in rows}
+    return [(place, {'user_id': uid, 'name': names.get(uid, 'Пользователь'), 'refs_count': refs_count})
+            for place, uid, refs_count in nearby]
 
 async def get_user_tournament_position(tournament_id: int, user_id: int):
     """Получает позицию пользователя в турнире"""
-    async with db_pool.acquire() as conn:
-        position = await conn.fetchval(
-            '''SELECT COUNT(*) + 1
-               FROM tournament_participants tp1
-               WHERE tp1.tournament_id = $1
-               AND tp1.refs_count > (
-                   SELECT COALESCE(tp2.refs_count, 0)
-                   FROM tournament_participants tp2
-                   WHERE tp2.tournament_id = $1 AND tp2.user_id = $2
-               )''',
-            tournament_id, user_id
-        )
-        refs_count = await conn.fetchval(
-            'SELECT COALESCE(refs_count, 0) FROM tournament_participants WHERE tournament_id = $1 AND user_id = $2',
-            tournament_id, user_id
-        )
-        return {'position': position, 'refs_count': refs_count or 0}
+    index = await get_tournament_ranks(tournament_id)
+    return index.position(user_id)
 
 async def finish_tournament(tournament_id: int):
-    """Завершает турнир и выдает награды"""
-    async with db_pool.acquire() as conn:
-        # Получаем данные турнира
-        tournament = await conn.fetchrow(
-            'SELECT name, prize_places, prizes, trophy_file_ids FROM tournaments WHERE id = $1',
-            tournament_id
-        )
+    """Завершает турнир и выдает награды.
+
+    Закрытие и все выплаты идут одной транзакцией за три запроса при любом
+    числе призовых мест. Если турнир уже завершён, возвращает False.
+    """
+    import json
+    async with db_transaction() as conn:
+        tournament = await sql_fetchrow(conn, 'close_tournament_for_payout', tournament_id)
 
         if not tournament:
             return False
 
         # Важно: гарантируем, что prizes это словарь
-        import json
         prizes = tournament['prizes']
         if isinstance(prizes, str):
             try:
@@ -641,82 +1793,106 @@ async def finish_tournament(tournament_id: int):
             trophy_file_ids = {}
 
         # Получаем топ участников
-        winners_rows = await conn.fetch(
-            '''SELECT user_id, refs_count, 
-               ROW_NUMBER() OVER (ORDER BY refs_count DESC) as place
-               FROM tournament_participants
-               WHERE tournament_id = $1
-               ORDER BY refs_count DESC
-               LIMIT $2''',
-            tournament_id, tournament['prize_places']
-        )
+        winners_rows = await sql_fetch(conn, 'get_tournament_winners', tournament_id, tournament['prize_places'])
 
         winners = []
+        user_ids, places, file_ids, amounts = [], [], [], []
         for row in winners_rows:
+            place = int(row['place'])
             winners.append({
                 'user_id': row['user_id'],
                 'refs_count': row['refs_count'],
-                'place': row['place']
+                'place': place
             })
 
-        # Выдаем награды
-        now = int(time.time())
-        from decimal import Decimal
-        for winner in winners:
-            place = int(winner['place'])
-            user_id = winner['user_id']
-
             place_str = str(place)
             if place_str in prizes:
-                prize_stars = float(prizes[place_str])
-                trophy_file_id = trophy_file_ids.get(place_str, trophy_file_ids.get('default', ''))
+                user_ids.append(row['user_id'])
+                places.append(place)
+                file_ids.append(trophy_file_ids.get(place_str, trophy_file_ids.get('default', '')))
+                amounts.append(Decimal(str(float(prizes[place_str]))))
+
+        # Награды и звезды на баланс — одним запросом
+        if user_ids:
+            paid = await sql_fetch(conn, 'pay_tournament_prizes',
+                tournament_id, tournament['name'], int(time.time()),
+                user_ids, places, file_ids, amounts
+            )
+        else:
+            paid = []
 
-                # Добавляем награду в таблицу
-                await conn.execute(
-                    '''INSERT INTO user_trophies 
-                       (user_id, tournament_id, tournament_name, place, trophy_file_id, prize_stars, date_received)
-                       VALUES ($1, $2, $3, $4, $5, $6, $7)''',
-                    user_id, tournament_id, tournament['name'], place, 
-                    trophy_file_id, Decimal(str(prize_stars)), now
-                )
+    # Кэши обновляем только после фиксации транзакции
+    for row in paid:
+        note_user_balance(row['user_id'], float(row['balance']))
+    trophy_counts.invalidate(user_ids)
 
-                # Добавляем звезды на баланс
-                await conn.execute(
-                    'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
-                    Decimal(str(prize_stars)), user_id
-                )
+    tournament_ranks.forget(tournament_id)
+    active_tournament_cache.invalidate()
+    return winners
 
-        # Закрываем турнир
-        await conn.execute(
-            'UPDATE tournaments SET status = $1 WHERE id = $2',
-            'finished', tournament_id
-        )
+class TrophyCountCache:
+    """Число наград пользователя в памяти процесса.
 
-        return winners
-
-async def get_user_trophies(user_id: int):
-    """Получает все награды пользователя"""
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''SELECT id, tournament_name, place, trophy_file_id, prize_stars, date_received
-               FROM user_trophies
-               WHERE user_id = $1
-               ORDER BY date_received DESC''',
-            user_id
-        )
-        return [{'id': row['id'], 'tournament_name': row['tournament_name'],
-                 'place': row['place'], 'trophy_file_id': row['trophy_file_id'],
-                 'prize_stars': float(row['prize_stars']), 'date_received': row['date_received']}
-                for row in rows]
+    Меняется только при выдаче наград, поэтому живёт до invalidate().
+    generation защищает от записи значения, прочитанного до выдачи.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.counts = OrderedDict()
+        self.generation = 0
+
+    def get(self, user_id: int):
+        count = self.counts.get(user_id)
+        if count is not None:
+            self.counts.move_to_end(user_id)
+        return count
+
+    def set(self, user_id: int, count: int, generation: int):
+        if generation != self.generation:
+            return
+        self.counts[user_id] = count
+        self.counts.move_to_end(user_id)
+        while len(self.counts) > self.size:
+            self.counts.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        self.generation += 1
+        for user_id in user_ids:
+            self.counts.pop(user_id, None)
+
+trophy_counts = TrophyCountCache(TROPHY_COUNT_CACHE_SIZE)
+
+def trophy_from_row(row):
+    return {'id': row['id'], 'tournament_name': row['tournament_name'],
+            'place': row['place'], 'trophy_file_id': row['trophy_file_id'],
+            'prize_stars': float(row['prize_stars']), 'date_received': row['date_received']}
+
+async def get_trophy_page(user_id: int, cursor=None, direction: str = 'next'):
+    """Возвращает (награда, всего наград, первая ли это страница). cursor — (date_received, id) текущей награды.
+
+    Без курсора или если соседней награды нет — первая (самая свежая) награда.
+    """
+    generation = trophy_counts.generation
+    total = trophy_counts.get(user_id)
+    async with db_connection() as conn:
+        row = None
+        if cursor is not None:
+            query = 'get_next_trophy' if direction == 'next' else 'get_prev_trophy'
+            row = await sql_fetchrow(conn, query, user_id, *cursor)
+        first = row is None
+        if first:
+            row = await sql_fetchrow(conn, 'get_first_trophy', user_id)
+        if total is None:
+            total = await sql_fetchval(conn, 'count_user_trophies', user_id)
+            trophy_counts.set(user_id, total, generation)
+    return (trophy_from_row(row) if row else None), total, first
 
 async def get_admin_tournament_creation_state(admin_id: int):
     """Получает состояние создания турнира админом"""
     import json
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT step, data FROM admin_tournament_creation WHERE admin_id = $1',
-            admin_id
-        )
+    async with db_connection() as conn:
+        row = await sql_fetchrow(conn, 'get_admin_tournament_creation_state', admin_id)
         if row:
             return {'step': row['step'], 'data': json.loads(row['data'])}
         return None
@@ -724,29 +1900,127 @@ async def get_admin_tournament_creation_state(admin_id: int):
 async def set_admin_tournament_creation_state(admin_id: int, step: str, data: dict):
     """Устанавливает состояние создания турнира админом"""
     import json
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO admin_tournament_creation (admin_id, step, data, updated_at)
-               VALUES ($1, $2, $3, NOW())
-               ON CONFLICT (admin_id)
-               DO UPDATE SET step = $2, data = $3, updated_at = NOW()''',
-            admin_id, step, json.dumps(data)
-        )
+    async with db_connection() as conn:
+        await sql_execute(conn, 'set_admin_tournament_creation_state', admin_id, step, json.dumps(data))
 
 async def delete_admin_tournament_creation_state(admin_id: int):
     """Удаляет состояние создания турнира админом"""
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            'DELETE FROM admin_tournament_creation WHERE admin_id = $1',
-            admin_id
-        )
+    async with db_connection() as conn:
+        await sql_execute(conn, 'delete_admin_tournament_creation_state', admin_id)
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+class SubscriptionCache:
+    """Статус подписки на канал в памяти процесса.
+
+    entries: user_id -> [подписан, время проверки, время последнего обращения].
+    Результат get_chat_member живёт ttl секунд; апдейты chat_member по каналу
+    записываются сразу через set().
+    """
 
-async def check_subscription(user_id: int) -> bool:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.entries = {}
+
+    def set(self, user_id: int, subscribed: bool):
+        entry = self.entries.get(user_id)
+        last_seen = entry[2] if entry else 0
+        self.entries[user_id] = [subscribed, time.time(), last_seen]
+
+    async def fetch(self, user_id: int) -> bool:
+        try:
+            member = await bot.get_chat_member(CHANNEL_ID, user_id)
+            subscribed = member.status in SUBSCRIBED_STATUSES
+        except:
+            return False
+        self.set(user_id, subscribed)
+        return subscribed
+
+    async def check(self, user_id: int, force: bool = False) -> bool:
+        entry = self.entries.get(user_id)
+        now = time.time()
+        if entry is not None:
+            entry[2] = now
+            if not force and now - entry[1] < self.ttl:
+                return entry[0]
+        subscribed = await self.fetch(user_id)
+        if user_id in self.entries:
+            self.entries[user_id][2] = now
+        return subscribed
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_CACHE_TTL)
+
+async def check_subscription(user_id: int, force: bool = False) -> bool:
+    return await subscription_cache.check(user_id, force)
+
+@dp.chat_member(F.chat.id == CHANNEL_ID)
+async def channel_member_updated(event: types.ChatMemberUpdated):
+    # Бот должен быть администратором канала, иначе Telegram не присылает эти апдейты
+    subscription_cache.set(event.new_chat_member.user.id, event.new_chat_member.status in SUBSCRIBED_STATUSES)
+
+@dp.message.outer_middleware()
+async def message_subscription_gate(handler, event: types.Message, data: dict):
+    user = event.from_user
+    # /start проверяет подписку сам, чтобы сохранить реферала до подписки
+    if (user is None or is_admin(user.id)
+            or (event.text and event.text.startswith('/start'))):
+        return await handler(event, data)
+
+    if not await check_subscription(user.id):
+        await send_subscription_message(event.chat.id)
+        return
+    return await handler(event, data)
+
+@dp.callback_query.outer_middleware()
+async def callback_subscription_gate(handler, event: types.CallbackQuery, data: dict):
+    user = event.from_user
+    if (is_admin(user.id) or event.message is None
+            or event.data == 'check_subscription' or (event.data or '').startswith('reply_admin_')):
+        return await handler(event, data)
+
+    if not await check_subscription(user.id):
+        try:
+            await event.message.delete()
+        except:
+            pass
+        await send_subscription_message(event.message.chat.id)
+        await event.answer()
+        return
+    return await handler(event, data)
+
+@dp.update.outer_middleware()
+async def update_unit_of_work(handler, event: types.Update, data: dict):
+    uow = UnitOfWork(db_pool)
+    token = current_uow.set(uow)
+    try:
+        return await handler(event, data)
+    finally:
+        current_uow.reset(token)
+        await uow.close()
+
+@dp.message.outer_middleware()
+async def message_user_context(handler, event: types.Message, data: dict):
+    if event.from_user is None:
+        return await handler(event, data)
+    token = user_context.set(await load_user_context(event.from_user, create=False))
     try:
-        member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except:
-        return False
+        return await handler(event, data)
+    finally:
+        user_context.reset(token)
+
+@dp.callback_query.outer_middleware()
+async def callback_user_context(handler, event: types.CallbackQuery, data: dict):
+    # Кнопка проверки подписки сама создаёт пользователя, чтобы засчитать реферала
+    create = event.data != 'check_subscription'
+    token = user_context.set(await load_user_context(event.from_user, create=create))
+    try:
+        return await handler(event, data)
+    finally:
+        user_context.reset(token)
+
+# Регистрируется последней: состояние к этому моменту уже лежит в кэше хранилища
+dp.message.outer_middleware(dp.fsm)
+dp.callback_query.outer_middleware(dp.fsm)
 
 async def send_subscription_message(chat_id: int):
     markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -798,7 +2072,7 @@ class UserStates(StatesGroup):
 
 async def show_menu(chat_id: int, user_id: str = None):
     if user_id:
-        await increment_user_session(int(user_id))
+        callback_dedup.bump_epoch(int(user_id))
 
     # Проверяем наличие активного турнира
     active_tournament = await get_active_tournament()
@@ -903,8 +2177,8 @@ async def sendall_handler(message: types.Message):
         return
 
     # Получаем всех пользователей из БД
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch('SELECT user_id FROM users')
+    async with bulk_pool.acquire() as conn:
+        users = await sql_fetch(conn, 'get_all_user_ids')
 
     if not users:
         await message.reply("❌ В базе данных нет пользователей")
@@ -955,17 +2229,15 @@ async def add_promo_handler(message: types.Message):
             await message.reply("❌ Формат: `/addpromo КОД СУММА КОЛ_ВО`", parse_mode='HTML')
             return
 
-        code = parts[1]
+        code = normalize_promo_code(parts[1])
         reward = float(parts[2])
         uses = int(parts[3])
 
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO promos (code, reward, uses) VALUES ($1, $2, $3) ON CONFLICT (code) DO UPDATE SET reward = $2, uses = $3',
-                code, reward, uses
-            )
-            await message.reply(f"✅ Промокод `<b>{code}</b>` успешно добавлен!\n💰 Награда: {reward}⭐️\n👥 Кол-во использований: {uses}", parse_mode='HTML')
-            print(f"[ADMIN] Admin {uid} added/updated promo: {code} ({reward} stars, {uses} uses)")
+        async with db_connection() as conn:
+            await save_promo(conn, code, reward, uses)
+
+        await message.reply(f"✅ Промокод `<b>{code}</b>` успешно добавлен!\n💰 Награда: {reward}⭐️\n👥 Кол-во использований: {uses}", parse_mode='HTML')
+        print(f"[ADMIN] Admin {uid} added/updated promo: {code} ({reward} stars, {uses} uses)")
 
     except ValueError:
         await message.reply("❌ Сумма и количество должны быть числами!")
@@ -981,23 +2253,40 @@ async def list_promos_handler(message: types.Message):
         return
 
     try:
-        async with db_pool.acquire() as conn:
-            promos = await conn.fetch('SELECT code, reward, uses FROM promos ORDER BY code')
+        async with db_connection() as conn:
+            promos = await sql_fetch(conn, 'list_promos')
 
-            if not promos:
-                await message.reply("Список промокодов пуст.")
-                return
+        if not promos:
+            await message.reply("Список промокодов пуст.")
+            return
 
-            text = "🎫 <b>Список промокодов:</b>\n\n"
-            for p in promos:
-                text += f"• <code>{p['code']}</code> — {p['reward']}⭐️ (осталось: {p['uses']})\n"
+        text = "🎫 <b>Список промокодов:</b>\n\n"
+        for p in promos:
+            text += f"• <code>{p['code']}</code> — {p['reward']}⭐️ (осталось: {p['uses']})\n"
 
-            await message.reply(text, parse_mode='HTML')
+        await message.reply(text, parse_mode='HTML')
 
     except Exception as e:
         print(f"[ADMIN] Error listing promos: {e}")
         await message.reply(f"❌ Ошибка: {e}")
 
+@dp.message(Command("sqlstats"))
+async def sql_stats_handler(message: types.Message):
+    """Статистика SQL-запросов из реестра (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    if not sql_stats:
+        await message.reply("Запросов к базе ещё не было.")
+        return
+
+    top = sorted(sql_stats.items(), key=lambda item: item[1][1], reverse=True)[:20]
+    text = "📊 <b>SQL-запросы (по суммарному времени):</b>\n\n"
+    for name, (calls, total) in top:
+        text += f"• <code>{name}</code> — {calls} выз., {total * 1000:.0f} мс (ср. {total * 1000 / calls:.2f} мс)\n"
+
+    await message.reply(text, parse_mode='HTML')
+
 @dp.message(Command("create_tournament"))
 async def create_tournament_handler(message: types.Message):
     if not is_admin(message.from_user.id):
@@ -1064,15 +2353,9 @@ async def end_tournament_handler(message: types.Message):
     tournament_name = command_parts[1].strip()
 
     # Ищем турнир по названию (регистронезависимо и с обрезкой пробелов) или по ID
-    async with db_pool.acquire() as conn:
+    async with db_connection() as conn:
         import json
-        tournament_row = await conn.fetchrow(
-            '''SELECT id, name, prize_places, prizes, trophy_file_ids 
-               FROM tournaments 
-               WHERE (UPPER(TRIM(name)) = UPPER(TRIM($1)) OR id::text = $1) AND status = 'active' 
-               ORDER BY id DESC LIMIT 1''',
-            tournament_name
-        )
+        tournament_row = await sql_fetchrow(conn, 'find_active_tournament_by_name', tournament_name)
 
     if not tournament_row:
         await message.reply(f"❌ Активный турнир с названием '{tournament_name}' не найден")
@@ -1095,6 +2378,9 @@ async def end_tournament_handler(message: types.Message):
     }
 
     winners = await finish_tournament(tournament['id'])
+    if winners is False:
+        await message.reply(f"❌ Турнир <b>{tournament['name']}</b> уже завершен", parse_mode='HTML')
+        return
 
     text = f"✅ Турнир <b>{tournament['name']}</b> завершен!\n\n<b>Победители:</b>\n"
 
@@ -1232,7 +2518,7 @@ async def start_command_logic(message: types.Message):
         await send_subscription_message(message.chat.id)
         return
 
-    await increment_user_session(uid)
+    callback_dedup.bump_epoch(uid)
     await delete_user_state(uid)
 
     user = await get_user(uid)
@@ -1257,10 +2543,9 @@ async def handle_query(call: types.CallbackQuery):
     user_id = str(call.from_user.id)
     user_id_int = call.from_user.id
     chat_id = call.message.chat.id
-    msg_id = call.message.message_id
 
     if call.data == 'check_subscription':
-        if await check_subscription(call.from_user.id):
+        if await check_subscription(call.from_user.id, force=True):
             try:
                 await call.message.delete()
             except:
@@ -1320,48 +2605,34 @@ async def handle_query(call: types.CallbackQuery):
             [types.InlineKeyboardButton(text="❌ Отмена", callback_data='menu')]
         ])
         await bot.send_message(chat_id, "✍️ Введите ваш ответ администратору:", reply_markup=markup)
-        user_states[user_id] = {'state': 'awaiting_admin_reply', 'admin_id': admin_id}
-        await set_user_state(user_id_int, user_states[user_id])
+        await set_user_state(user_id_int, {'state': 'awaiting_admin_reply', 'admin_id': admin_id})
         await call.answer()
         return
 
-    if not await check_subscription(call.from_user.id):
-        try:
-            await call.message.delete()
-        except:
-            pass
-        await send_subscription_message(chat_id)
+    if not await callback_dedup.claim(user_id_int, call.message):
         await call.answer()
         return
 
-    session = await get_user_session(user_id_int)
-    key = f"{user_id}:{msg_id}:{session}"
-
-    if await is_button_used(user_id_int, key):
-        await call.answer()
-        return
-    else:
-        await mark_button_used(user_id_int, key)
-
     user = await get_user(user_id_int)
     if not user:
         await create_user(user_id_int, call.from_user.first_name or 'Пользователь', call.from_user.username or '')
         user = await get_user(user_id_int)
 
-    data = call.data
+    # Кнопки повтора и выбора в КНБ несут ставку в подписанном callback_data
+    data, signed_bet = verify_bet_callback(user_id_int, call.data or '')
     back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="◀️ Вернуться в меню", callback_data='menu')]
     ])
 
     # Не удаляем сообщение для tournaments и tournament - они отправят новое
-    if (not (call.data and call.data.startswith('knb_choice_'))
-        and call.data != 'knb_repeat_bet'
-        and call.data != 'dice_repeat_bet'
-        and call.data != 'basket_repeat_bet'
-        and call.data != 'casino_repeat_bet'
-        and call.data != 'bowling_repeat_bet'
-        and call.data != 'tournaments'
-        and call.data != 'tournament'):
+    if (not data.startswith('knb_choice_')
+        and data != 'knb_repeat_bet'
+        and data != 'dice_repeat_bet'
+        and data != 'basket_repeat_bet'
+        and data != 'casino_repeat_bet'
+        and data != 'bowling_repeat_bet'
+        and data != 'tournaments'
+        and data != 'tournament'):
         try:
             if call.message:
                 await call.message.delete()
@@ -1396,7 +2667,6 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id_int)] = 'awaiting_promo'
         await set_user_state(user_id_int, 'awaiting_promo')
 
     elif data == 'referral':
@@ -1470,9 +2740,23 @@ async def handle_query(call: types.CallbackQuery):
         await set_user_state(user_id_int, 'awaiting_support')
 
     elif data == 'trophies' or data.startswith('trophies_page_'):
-        trophies = await get_user_trophies(user_id_int)
+        # trophies_page_{n|p}_{номер}_{date_received}_{id}: листаем от показанной награды
+        page, cursor, direction = 0, None, 'next'
+        parts = data.split('_')
+        if len(parts) == 6:
+            try:
+                direction = 'next' if parts[2] == 'n' else 'prev'
+                page = int(parts[3])
+                cursor = (int(parts[4]), int(parts[5]))
+            except ValueError:
+                page, cursor = 0, None
+
+        trophy, total, first = await get_trophy_page(user_id_int, cursor, direction)
+        if first:
+            page = 0
+        page = max(0, min(page, total - 1))
 
-        if not trophies:
+        if trophy is None:
             await bot.send_message(
                 chat_id,
                 "🏅 <b>МОИ НАГРАДЫ</b>\n\n"
@@ -1482,15 +2766,6 @@ async def handle_query(call: types.CallbackQuery):
                 parse_mode='HTML'
             )
         else:
-            # Номер страницы
-            page = 0
-            if data.startswith('trophies_page_'):
-                page = int(data.split('_')[-1])
-
-            if page >= len(trophies):
-                page = 0
-
-            trophy = trophies[page]
             import datetime
             date_received = datetime.datetime.fromtimestamp(trophy['date_received'], MOSCOW_TZ).strftime('%d.%m.%Y')
 
@@ -1508,15 +2783,16 @@ async def handle_query(call: types.CallbackQuery):
 
             # Кнопки навигации
             buttons = []
-            if len(trophies) > 1:
+            if total > 1:
                 nav_row = []
+                position = f"{trophy['date_received']}_{trophy['id']}"
                 if page > 0:
-                    nav_row.append(types.InlineKeyboardButton(text="◀️", callback_data=f'trophies_page_{page-1}'))
+                    nav_row.append(types.InlineKeyboardButton(text="◀️", callback_data=f'trophies_page_p_{page-1}_{position}'))
 
-                nav_row.append(types.InlineKeyboardButton(text=f"📄 {page + 1} / {len(trophies)}", callback_data='noop'))
+                nav_row.append(types.InlineKeyboardButton(text=f"📄 {page + 1} / {total}", callback_data='noop'))
 
-                if page < len(trophies) - 1:
-                    nav_row.append(types.InlineKeyboardButton(text="▶️", callback_data=f'trophies_page_{page+1}'))
+                if page < total - 1:
+                    nav_row.append(types.InlineKeyboardButton(text="▶️", callback_data=f'trophies_page_n_{page+1}_{position}'))
                 buttons.append(nav_row)
 
             buttons.append([types.InlineKeyboardButton(text="◀️ Вернуться в меню", callback_data='menu')])
@@ -1548,88 +2824,42 @@ async def handle_query(call: types.CallbackQuery):
             # Получаем номер страницы
             page = 0
             if data.startswith('tournament_page_'):
-                page = int(data.split('_')[-1])
+                # Номер из callback_data может быть подделан: отрицательный OFFSET Postgres не примет
+                try:
+                    page = max(0, int(data.split('_')[-1]))
+                except ValueError:
+                    page = 0
 
-            # Получаем только активные турниры (идущие в данный момент)
-            import json
-            async with db_pool.acquire() as conn:
-                now = int(time.time())
-                all_tournaments = await conn.fetch(
-                    '''SELECT id, name, start_time, end_time, status, prize_places, prizes
-                       FROM tournaments
-                       WHERE status = 'active' AND start_time <= $1 AND end_time > $1
-                       ORDER BY start_time ASC''',
-                    now
-                )
+            # Одна страница — один активный турнир (идущий в данный момент)
+            now = int(time.time())
+            t, total = await tournament_pages.page(page, now)
 
-            if not all_tournaments:
+            if t is None:
                 await bot.send_message(
                     chat_id,
                     "ℹ️ Сейчас нет активных турниров",
                     reply_markup=back_markup
                 )
             else:
-                import datetime
-                now = int(time.time())
-
-                # Показываем только один турнир на странице
-                if page >= len(all_tournaments):
+                if page >= total:
                     page = 0
-
-                t = all_tournaments[page]
-                start_dt = datetime.datetime.fromtimestamp(t['start_time'], MOSCOW_TZ)
-                end_dt = datetime.datetime.fromtimestamp(t['end_time'], MOSCOW_TZ)
-
-                # Парсим prizes если это строка
-                prizes = t['prizes']
-                if isinstance(prizes, str):
-                    prizes = json.loads(prizes)
-
-                # Определяем статус
-                if t['start_time'] > now:
-                    status_emoji = "🔜"
-                    status_text = "Скоро начнется"
-                    time_info = f"⏰ Начало: {start_dt.strftime('%d.%m.%Y %H:%M')}"
-                else:
-                    status_emoji = "🔥"
-                    status_text = "Активен"
-                    time_left = t['end_time'] - now
-                    days_left = time_left // 86400
-                    hours_left = (time_left % 86400) // 3600
-                    time_info = f"⏰ Осталось: {days_left}д {hours_left}ч"
-
-                # Призы
-                max_prize = max([float(v) for v in prizes.values()])
-                prizes_text = "\n".join([
-                    f"{'🥇' if int(p) == 1 else '🥈' if int(p) == 2 else '🥉' if int(p) == 3 else '🏅'} {p} место: {v}⭐️"
-                    for p, v in prizes.items()
-                ])
-
-                text = (
-                    f"{status_emoji} <b>{t['name']}</b>\n\n"
-                    f"📊 Статус: {status_text}\n"
-                    f"{time_info}\n"
-                    f"📅 Конец: {end_dt.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"🏆 Призовых мест: {t['prize_places']}\n\n"
-                    f"<b>💰 Призы:</b>\n{prizes_text}\n\n"
-                    f"💡 Приглашай друзей, чтобы выиграть!"
-                )
+                text = tournament_pages.card(t, now)
 
                 # Создаем кнопки навигации
                 buttons = []
 
                 # Если турниров больше одного, добавляем навигацию
-                if len(all_tournaments) > 1:
+                if total > 1:
                     nav_row = []
                     if page > 0:
                         nav_row.append(types.InlineKeyboardButton(text="◀️ Предыдущий", callback_data=f'tournament_page_{page-1}'))
-                    if page < len(all_tournaments) - 1:
+                    if page < total - 1:
                         nav_row.append(types.InlineKeyboardButton(text="Следующий ▶️", callback_data=f'tournament_page_{page+1}'))
                     if nav_row:
                         buttons.append(nav_row)
 
                     # Индикатор страницы (с callback_data='noop' для некликабельности)
-                    buttons.append([types.InlineKeyboardButton(text=f"📄 {page + 1} из {len(all_tournaments)}", callback_data='noop')])
+                    buttons.append([types.InlineKeyboardButton(text=f"📄 {page + 1} из {total}", callback_data='noop')])
 
                 buttons.append([types.InlineKeyboardButton(text="🏆 Список лидеров 🏅", callback_data=f'tournament_leaderboard_{t["id"]}')])
                 buttons.append([types.InlineKeyboardButton(text="◀️ Вернуться в меню", callback_data='menu')])
@@ -1654,8 +2884,8 @@ async def handle_query(call: types.CallbackQuery):
         tournament_id = int(data.split('_')[-1])
         leaderboard = await get_tournament_leaderboard(tournament_id, 10)
 
-        async with db_pool.acquire() as conn:
-            t_row = await conn.fetchrow('SELECT name FROM tournaments WHERE id = $1', tournament_id)
+        async with db_connection() as conn:
+            t_row = await sql_fetchrow(conn, 'get_tournament_name', tournament_id)
             t_name = t_row['name'] if t_row else "Турнир"
 
         text = f"🏅 <b>Список лидеров: {t_name}</b>\n\n"
@@ -1704,9 +2934,6 @@ async def handle_query(call: types.CallbackQuery):
             days_left = time_left // 86400
             hours_left = (time_left % 86400) // 3600
 
-            # Добавляем пользователя в турнир (если еще не участвует)
-            await add_tournament_participant(tournament['id'], user_id_int)
-
             # Получаем позицию пользователя
             user_pos = await get_user_tournament_position(tournament['id'], user_id_int)
 
@@ -1733,6 +2960,13 @@ async def handle_query(call: types.CallbackQuery):
                 emoji = {1: "🥇", 2: "🥈", 3: "🥉"}.get(idx, "▫️")
                 text += f"{emoji} {leader['name']} - {leader['refs_count']} реф.\n"
 
+            # Участнику за пределами топа показываем соседей по рейтингу
+            if user_pos['refs_count'] and user_pos['position'] > len(leaderboard):
+                nearby = await get_tournament_neighbours(tournament['id'], user_id_int)
+                text += "\n<b>📍 Рядом с тобой:</b>\n"
+                for place, neighbour in nearby:
+                    text += f"#{place} {neighbour['name']} - {neighbour['refs_count']} реф.\n"
+
             text += "\n💡 Приглашай друзей, чтобы подняться в рейтинге!"
 
             await bot.send_message(
@@ -1767,28 +3001,8 @@ async def handle_query(call: types.CallbackQuery):
 
     elif data == 'knb_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
-
-        # Сначала пробуем из памяти, потом из БД
-        last_state = user_states.get(uid)
-        if not isinstance(last_state, dict) or 'last_knb_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
-            if db_state:
-                import json
-                try:
-                    if isinstance(db_state, str):
-                        last_state = json.loads(db_state)
-                    else:
-                        last_state = db_state
-                except:
-                    last_state = {}
-            else:
-                last_state = {}
 
-        bet = last_state.get('last_knb_bet')
-        if not bet:
-            # Fallback check for 'bet' key which might be used during the game
-            bet = last_state.get('bet')
+        bet = signed_bet
 
         if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -1797,22 +3011,17 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        # Устанавливаем текущую ставку для выбора предмета
-        user_states[uid] = {'bet': bet, 'last_knb_bet': bet}
-        await set_user_state(user_id_int, user_states[uid])
-
         markup = types.InlineKeyboardMarkup(row_width=3, inline_keyboard=[
-            [types.InlineKeyboardButton(text="✊ Камень", callback_data="knb_choice_rock"),
-             types.InlineKeyboardButton(text="✌️ Ножницы", callback_data="knb_choice_scissors"),
-             types.InlineKeyboardButton(text="🖐 Бумага", callback_data="knb_choice_paper")]
+            [types.InlineKeyboardButton(text="✊ Камень", callback_data=sign_bet_callback(user_id_int, 'knb_choice_rock', bet)),
+             types.InlineKeyboardButton(text="✌️ Ножницы", callback_data=sign_bet_callback(user_id_int, 'knb_choice_scissors', bet)),
+             types.InlineKeyboardButton(text="🖐 Бумага", callback_data=sign_bet_callback(user_id_int, 'knb_choice_paper', bet))]
         ])
         await bot.send_message(chat_id, "Выбери снова:", reply_markup=markup)
 
@@ -1833,28 +3042,12 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_casino_bet'
+        await set_user_state(user_id_int, 'awaiting_casino_bet')
 
     elif data == 'casino_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
-
-        last_state = user_states.get(uid)
-        if not isinstance(last_state, dict) or 'last_casino_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
-            if db_state:
-                import json
-                try:
-                    if isinstance(db_state, str):
-                        last_state = json.loads(db_state)
-                    else:
-                        last_state = db_state
-                except:
-                    last_state = {}
-            else:
-                last_state = {}
 
-        bet = last_state.get('last_casino_bet') if isinstance(last_state, dict) else None
+        bet = signed_bet
         if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
@@ -1862,19 +3055,24 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
+        # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+        new_balance = await settle_bet(user_id_int, bet, 0)
+        if new_balance is None:
+            markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
+            ])
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
+            return
 
         msg = await bot.send_dice(chat_id, emoji='🎰')
         value = msg.dice.value if msg.dice else 0
-        await asyncio.sleep(2)
 
         win = 0
         result_text = ""
@@ -1894,8 +3092,9 @@ async def handle_query(call: types.CallbackQuery):
         else:
             result_text = f"😓 Увы, звёзды не сошлись...\nТы проиграл {bet} ⭐️."
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
+        # Выигрыш известен сразу после броска — начисляем его до анимации
+        new_balance = await pay_win(user_id_int, win, new_balance)
+        await asyncio.sleep(2)
 
         final_message = (
             f"🧠 <b>Результат игры</b>\n"
@@ -1904,15 +3103,12 @@ async def handle_query(call: types.CallbackQuery):
         )
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='casino_repeat_bet'),
+            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(user_id_int, 'casino_repeat_bet', bet)),
              types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
             [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
         ])
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
-        new_state = {'last_casino_bet': bet}
-        user_states[uid] = new_state
-        await set_user_state(user_id_int, new_state)
 
     elif data == 'game_knb':
         back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -1931,40 +3127,45 @@ async def handle_query(call: types.CallbackQuery):
             parse_mode='HTML'
         )
         new_state = {"state": "awaiting_knb_bet"}
-        user_states[str(user_id)] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data and data.startswith('knb_choice_'):
         user_choice = data.split('_')[-1]
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
-        # Пытаемся получить состояние из памяти или БД
-        user_state = user_states.get(uid)
-        if not isinstance(user_state, dict) or 'bet' not in user_state:
-            user_state = await get_user_state(user_id_int)
+        bet = signed_bet
 
-        if not isinstance(user_state, dict) or 'bet' not in user_state:
+        if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        bet = user_state['bet']
-        balance = await get_user_balance(user_id_int)
+        bot_choice = random.choice(['rock', 'paper', 'scissors'])
+        choices_emoji = {'rock': '✊', 'scissors': '✌️', 'paper': '🖐'}
+        win_map = {'rock': 'scissors', 'scissors': 'paper', 'paper': 'rock'}
 
-        if bet > balance:
+        # Вычисляем результат
+        if user_choice == bot_choice:
+            result_text = "🤝 <b>Ничья!</b> Твоя ставка возвращается."
+            delta = 0
+        elif win_map[user_choice] == bot_choice:
+            delta = round(bet * 0.9, 2)
+            result_text = f"🎉 <b>Ты победил!</b>\nТы заработал <b>+{delta} ⭐️</b>!"
+        else:
+            delta = -bet
+            result_text = f"💥 <b>Ты проиграл...</b>\nПроиграно <b>{bet} ⭐️</b>"
+
+        # Ставка и выигрыш проводятся одним запросом ещё до анимации
+        new_balance = await settle_bet(user_id_int, bet, bet + delta)
+        if new_balance is None:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для этой ставки.", reply_markup=markup)
             return
 
-        bot_choice = random.choice(['rock', 'paper', 'scissors'])
-        choices_emoji = {'rock': '✊', 'scissors': '✌️', 'paper': '🖐'}
-        win_map = {'rock': 'scissors', 'scissors': 'paper', 'paper': 'rock'}
-
         # Step 1: Отправляем "Вы выбрали:"
         await bot.send_message(chat_id, "<b>🧍‍♂️ Ты выбрал:</b>", parse_mode='HTML')
         await asyncio.sleep(0.7)
@@ -1982,20 +3183,6 @@ async def handle_query(call: types.CallbackQuery):
         await asyncio.sleep(0.7)
         # Step 5: Отправляем финальный результат
 
-        # Вычисляем результат
-        if user_choice == bot_choice:
-            result_text = "🤝 <b>Ничья!</b> Твоя ставка возвращается."
-            delta = 0
-        elif win_map[user_choice] == bot_choice:
-            delta = round(bet * 0.9, 2)
-            result_text = f"🎉 <b>Ты победил!</b>\nТы заработал <b>+{delta} ⭐️</b>!"
-        else:
-            delta = -bet
-            result_text = f"💥 <b>Ты проиграл...</b>\nПроиграно <b>{bet} ⭐️</b>"
-
-        await update_user_balance(user_id_int, delta)
-        new_balance = await get_user_balance(user_id_int)
-
         # Собираем финальное сообщение в новом формате
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2008,18 +3195,13 @@ async def handle_query(call: types.CallbackQuery):
         )
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🔁 Ещё раз (та же ставка)", callback_data='knb_repeat_bet')],
+            [types.InlineKeyboardButton(text="🔁 Ещё раз (та же ставка)", callback_data=sign_bet_callback(user_id_int, 'knb_repeat_bet', bet))],
             [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
             [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
         ])
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
 
-        # Сохраняем для повтора и обновляем состояние в БД
-        new_state = {'last_knb_bet': bet, 'bet': bet}
-        user_states[uid] = new_state
-        await set_user_state(user_id_int, new_state)
-
     elif data == 'game_dice':
         back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="◀️ К мини-играм", callback_data='games')]
@@ -2036,18 +3218,12 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_dice_bet'
+        await set_user_state(user_id_int, 'awaiting_dice_bet')
 
-    elif data == 'knb_repeat_bet':
+    elif data == 'dice_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
-        # Сначала пробуем из памяти, потом из БД
-        last_state = user_states.get(uid)
-        if not last_state or 'last_knb_bet' not in last_state:
-            last_state = await get_user_state(user_id_int)
-
-        bet = last_state.get('last_knb_bet') if isinstance(last_state, dict) else None
+        bet = signed_bet
 
         if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2056,62 +3232,22 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        # Устанавливаем текущую ставку для выбора предмета
-        user_states[uid] = {'bet': bet, 'last_knb_bet': bet}
-
-        markup = types.InlineKeyboardMarkup(row_width=3, inline_keyboard=[
-            [types.InlineKeyboardButton(text="✊ Камень", callback_data="knb_choice_rock"),
-             types.InlineKeyboardButton(text="✌️ Ножницы", callback_data="knb_choice_scissors"),
-             types.InlineKeyboardButton(text="🖐 Бумага", callback_data="knb_choice_paper")]
-        ])
-        await bot.send_message(chat_id, "Выбери снова:", reply_markup=markup)
-
-    elif data == 'dice_repeat_bet':
-        chat_id = call.message.chat.id
-        uid = str(user_id_int)
-
-        last_state = user_states.get(uid)
-        if not isinstance(last_state, dict) or 'last_dice_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
-            if db_state:
-                import json
-                try:
-                    if isinstance(db_state, str):
-                        last_state = json.loads(db_state)
-                    else:
-                        last_state = db_state
-                except:
-                    last_state = {}
-            else:
-                last_state = {}
-
-        bet = last_state.get('last_dice_bet') if isinstance(last_state, dict) else None
-
-        if not bet:
-            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
-            ])
-            await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
-            return
-
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+        new_balance = await settle_bet(user_id_int, bet, 0)
+        if new_balance is None:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
-
         await bot.send_message(chat_id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
         user_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
         user_value = user_dice_msg.dice.value if user_dice_msg.dice else 1
@@ -2120,7 +3256,6 @@ async def handle_query(call: types.CallbackQuery):
         await bot.send_message(chat_id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
         bot_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
         bot_value = bot_dice_msg.dice.value if bot_dice_msg.dice else 1
-        await asyncio.sleep(3)
 
         delta = 0
         if user_value > bot_value:
@@ -2132,8 +3267,9 @@ async def handle_query(call: types.CallbackQuery):
         else:
             result_text = f"💥 <b>Поражение!</b> Ты потерял <b>{bet} ⭐️</b>"
 
-        await update_user_balance(user_id_int, delta)
-        new_balance = await get_user_balance(user_id_int)
+        # Выигрыш известен сразу после броска — начисляем его до анимации
+        new_balance = await pay_win(user_id_int, delta, new_balance)
+        await asyncio.sleep(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2146,15 +3282,12 @@ async def handle_query(call: types.CallbackQuery):
         )
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='dice_repeat_bet')],
+            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(user_id_int, 'dice_repeat_bet', bet))],
             [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
             [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
         ])
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
-        new_state = {'last_dice_bet': bet}
-        user_states[uid] = new_state
-        await set_user_state(user_id_int, new_state)
 
     elif data == 'game_basket':
         back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2172,28 +3305,12 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_basket_bet'
+        await set_user_state(user_id_int, 'awaiting_basket_bet')
 
     elif data == 'basket_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
-
-        last_state = user_states.get(uid)
-        if not isinstance(last_state, dict) or 'last_basket_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
-            if db_state:
-                import json
-                try:
-                    if isinstance(db_state, str):
-                        last_state = json.loads(db_state)
-                    else:
-                        last_state = db_state
-                except:
-                    last_state = {}
-            else:
-                last_state = {}
 
-        bet = last_state.get('last_basket_bet') if isinstance(last_state, dict) else None
+        bet = signed_bet
 
         if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2202,19 +3319,24 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
+        # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+        new_balance = await settle_bet(user_id_int, bet, 0)
+        if new_balance is None:
+            markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
+            ])
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
+            return
 
         throw_msg = await bot.send_dice(chat_id, emoji="🏀")
         value = throw_msg.dice.value
-        await asyncio.sleep(3)
 
         if value in (4, 5):
             win = round(bet * 2)
@@ -2223,8 +3345,9 @@ async def handle_query(call: types.CallbackQuery):
             win = 0
             result_text = f"💥 <b> Мимо!</b>\n\n Ты проиграл <b>{bet}</b> ⭐️"
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
+        # Выигрыш известен сразу после броска — начисляем его до анимации
+        new_balance = await pay_win(user_id_int, win, new_balance)
+        await asyncio.sleep(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2235,15 +3358,12 @@ async def handle_query(call: types.CallbackQuery):
         )
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='basket_repeat_bet')],
+            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(user_id_int, 'basket_repeat_bet', bet))],
             [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
             [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
         ])
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
-        new_state = {'last_basket_bet': bet}
-        user_states[uid] = new_state
-        await set_user_state(user_id_int, new_state)
 
     elif data == 'game_bowling':
         back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2261,18 +3381,10 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_bowling_bet'
+        await set_user_state(user_id_int, 'awaiting_bowling_bet')
 
     elif data == 'bowling_repeat_bet':
-        uid = str(user_id_int)
-        last_state = user_states.get(uid)
-        if not last_state or 'last_bowling_bet' not in last_state:
-            last_state = await get_user_state(user_id_int)
-            if isinstance(last_state, str):
-                import json
-                last_state = json.loads(last_state)
-
-        bet = last_state.get('last_bowling_bet') if isinstance(last_state, dict) else None
+        bet = signed_bet
 
         if not bet:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2281,19 +3393,24 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Вернуться в меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
+        # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+        new_balance = await settle_bet(user_id_int, bet, 0)
+        if new_balance is None:
+            markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
+            ])
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
+            return
 
         throw_msg = await bot.send_dice(chat_id, emoji="🎳")
         value = throw_msg.dice.value
-        await asyncio.sleep(3)
 
         if value == 6:
             win = round(bet * 3, 2)
@@ -2305,8 +3422,9 @@ async def handle_query(call: types.CallbackQuery):
             win = 0
             result_text = f"💥 <b>Ты промазал...</b> Кегли устояли.\n\n<b>Проиграно {bet} ⭐️</b>"
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
+        # Выигрыш известен сразу после броска — начисляем его до анимации
+        new_balance = await pay_win(user_id_int, win, new_balance)
+        await asyncio.sleep(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2317,15 +3435,12 @@ async def handle_query(call: types.CallbackQuery):
         )
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='bowling_repeat_bet')],
+            [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(user_id_int, 'bowling_repeat_bet', bet))],
             [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
             [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
         ])
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
-        new_state = {'last_bowling_bet': bet}
-        user_states[uid] = new_state
-        await set_user_state(user_id_int, new_state)
 
     # Обработчик для кнопки-индикатора (не делает ничего)
     if data == 'noop':
@@ -2483,12 +3598,10 @@ async def handle_animation(message: types.Message):
 
 @dp.message()
 async def handle_user_input(message: types.Message):
-    uid = str(message.from_user.id)
     uid_int = message.from_user.id
 
     if message.text and message.text.startswith('/'):
         # This is a command, we should reset the state and let it be handled by command handlers
-        user_states[uid] = None
         await set_user_state(uid_int, None)
 
         # If the command has a specific handler, aiogram 3.x with Dispatcher 
@@ -2497,22 +3610,7 @@ async def handle_user_input(message: types.Message):
         # Let's ensure we return and DON'T consume the message if it's a command we want to handle elsewhere.
         return
 
-    if not await check_subscription(message.from_user.id):
-        await send_subscription_message(message.chat.id)
-        return
-    state_raw = user_states.get(uid)
-    if not state_raw:
-        db_state = await get_user_state(uid_int)
-        import json
-        try:
-            if isinstance(db_state, str):
-                state_raw = json.loads(db_state)
-            else:
-                state_raw = db_state
-            if state_raw:
-                user_states[uid] = state_raw
-        except:
-            state_raw = db_state
+    state_raw = await get_user_state(uid_int)
 
     state = state_raw
     if isinstance(state, dict):
@@ -2523,7 +3621,7 @@ async def handle_user_input(message: types.Message):
 
         result = await use_promo(uid_int, code)
         await message.reply(result['message'])
-        user_states[uid] = None
+        await set_user_state(uid_int, None)
 
     elif state == 'awaiting_support':
         try:
@@ -2557,7 +3655,6 @@ async def handle_user_input(message: types.Message):
             print(f"[ERROR] Failed to send support message to admin: {e}")
             await message.reply("❌ Произошла ошибка при отправке вопроса. Попробуйте позже.")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
 
     elif state == 'awaiting_withdraw':
@@ -2586,11 +3683,9 @@ async def handle_user_input(message: types.Message):
                 )
                 await bot.send_message(ADMIN_ID, admin_msg, parse_mode='HTML', reply_markup=admin_markup)
                 await message.reply("✅ Заявка на вывод успешно создана! Ожидайте обработки администратором.")
-                user_states[uid] = None
                 await set_user_state(uid_int, None)
             else:
                 await message.reply("❌ Ошибка при создании заявки. Попробуйте позже.")
-                user_states[uid] = None
                 await set_user_state(uid_int, None)
 
         except ValueError:
@@ -2620,7 +3715,6 @@ async def handle_user_input(message: types.Message):
             print(f"[ERROR] Failed to send reply to admin: {e}")
             await message.reply("❌ Ошибка при отправке ответа.")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
 
     # Обработка ввода ставки для КНБ
@@ -2637,15 +3731,13 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Введите доступную ставку:")
                 return
 
-            # Сохраняем ставку и переводим в состояние выбора предмета
-            new_state = {"state": "awaiting_knb_choice", "bet": bet}
-            user_states[uid] = new_state
-            await set_user_state(uid_int, new_state)
+            # Ставка уходит в подписанные кнопки выбора, в состоянии остаётся только этап
+            await set_user_state(uid_int, 'awaiting_knb_choice')
 
             markup = types.InlineKeyboardMarkup(row_width=3, inline_keyboard=[
-                [types.InlineKeyboardButton(text="✊ Камень", callback_data="knb_choice_rock"),
-                 types.InlineKeyboardButton(text="✌️ Ножницы", callback_data="knb_choice_scissors"),
-                 types.InlineKeyboardButton(text="🖐 Бумага", callback_data="knb_choice_paper")]
+                [types.InlineKeyboardButton(text="✊ Камень", callback_data=sign_bet_callback(uid_int, 'knb_choice_rock', bet)),
+                 types.InlineKeyboardButton(text="✌️ Ножницы", callback_data=sign_bet_callback(uid_int, 'knb_choice_scissors', bet)),
+                 types.InlineKeyboardButton(text="🖐 Бумага", callback_data=sign_bet_callback(uid_int, 'knb_choice_paper', bet))]
             ])
             await bot.send_message(message.chat.id, "Выбирай предмет:", parse_mode="HTML", reply_markup=markup)
 
@@ -2676,12 +3768,15 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
+            # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+            new_balance = await settle_bet(uid_int, bet, 0)
+            if new_balance is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки. Попробуйте еще раз:")
+                return
 
             await bot.send_message(message.chat.id, "🎰 <b>Твой спин:</b>", parse_mode="HTML")
             slot_msg = await bot.send_dice(message.chat.id, emoji="🎰")
             value = slot_msg.dice.value
-            await asyncio.sleep(2)
 
             win = 0
             result_text = ""
@@ -2704,8 +3799,9 @@ async def handle_user_input(message: types.Message):
                     f"Ты проиграл {bet} ⭐️"
                 )
 
-            await update_user_balance(uid_int, win)
-            new_balance = await get_user_balance(uid_int)
+            # Выигрыш известен сразу после броска — начисляем его до анимации
+            new_balance = await pay_win(uid_int, win, new_balance)
+            await asyncio.sleep(2)
 
             final_message = (
                 f"🧠 <b>Результат игры</b>\n"
@@ -2714,17 +3810,17 @@ async def handle_user_input(message: types.Message):
             )
 
             markup = types.InlineKeyboardMarkup(row_width=2, inline_keyboard=[
-                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='casino_repeat_bet'),
+                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(uid_int, 'casino_repeat_bet', bet)),
                  types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
                 [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
             ])
 
             await bot.send_message(message.chat.id, final_message, parse_mode='HTML', reply_markup=markup)
-            user_states[uid] = {'last_casino_bet': bet}
+            await set_user_state(uid_int, None)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
+            await set_user_state(uid_int, None)
 
     elif state == 'awaiting_dice_bet':
         try:
@@ -2740,26 +3836,31 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
+            # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+            new_balance = await settle_bet(uid_int, bet, 0)
+            if new_balance is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки. Попробуйте еще раз:")
+                return
 
             await bot.send_message(message.chat.id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
             user_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
             await asyncio.sleep(3)
             await bot.send_message(message.chat.id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
             bot_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
-            await asyncio.sleep(3)
 
             if user_dice > bot_dice:
                 win = round(bet * 1.9, 2)
-                await update_user_balance(uid_int, win)
                 result_text = f"🎉 Ты выиграл <b>{win}</b> ⭐️"
             elif user_dice < bot_dice:
+                win = 0
                 result_text = f"💥 Ты потерял <b>{bet}</b> ⭐️"
             else:
-                await update_user_balance(uid_int, bet)
+                win = bet
                 result_text = f"🤝 <b>Ничья!</b> Ставка <b>{bet}</b> ⭐️\n возвращается"
 
-            new_balance = await get_user_balance(uid_int)
+            # Выигрыш известен сразу после броска — начисляем его до анимации
+            new_balance = await pay_win(uid_int, win, new_balance)
+            await asyncio.sleep(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -2772,17 +3873,17 @@ async def handle_user_input(message: types.Message):
             )
 
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='dice_repeat_bet')],
+                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(uid_int, 'dice_repeat_bet', bet))],
                 [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
                 [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
             ])
 
             await bot.send_message(message.chat.id, final_message, parse_mode='HTML', reply_markup=markup)
-            user_states[uid] = {'last_dice_bet': bet}
+            await set_user_state(uid_int, None)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
+            await set_user_state(uid_int, None)
 
     elif state == 'awaiting_basket_bet':
         try:
@@ -2798,20 +3899,25 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
+            # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+            new_balance = await settle_bet(uid_int, bet, 0)
+            if new_balance is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки. Попробуйте еще раз:")
+                return
 
             throw_msg = await bot.send_dice(message.chat.id, emoji="🏀")
             value = throw_msg.dice.value
-            await asyncio.sleep(3)
 
             if value in (4, 5):
                 win = round(bet * 2)
-                await update_user_balance(uid_int, win)
                 result_text = f"🎉 <b>Попадание!</b>\n\n Ты выигрываешь <b>{win}</b> ⭐️"
             else:
+                win = 0
                 result_text = f"💥 <b> Мимо!</b>\n\n Ты проиграл <b>{bet}</b> ⭐️"
 
-            new_balance = await get_user_balance(uid_int)
+            # Выигрыш известен сразу после броска — начисляем его до анимации
+            new_balance = await pay_win(uid_int, win, new_balance)
+            await asyncio.sleep(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -2822,17 +3928,17 @@ async def handle_user_input(message: types.Message):
             )
 
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='basket_repeat_bet')],
+                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(uid_int, 'basket_repeat_bet', bet))],
                 [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
                 [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
             ])
 
             await bot.send_message(message.chat.id, final_message, parse_mode='HTML', reply_markup=markup)
-            user_states[uid] = {'last_basket_bet': bet}
+            await set_user_state(uid_int, None)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
+            await set_user_state(uid_int, None)
 
     elif state == 'awaiting_bowling_bet':
         try:
@@ -2847,11 +3953,14 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
+            # Ставка списывается до броска: без средств пользователь не увидит анимацию впустую
+            new_balance = await settle_bet(uid_int, bet, 0)
+            if new_balance is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки. Попробуйте еще раз:")
+                return
 
             throw_msg = await bot.send_dice(message.chat.id, emoji="🎳")
             value = throw_msg.dice.value
-            await asyncio.sleep(3)
 
             if value == 6:
                 win = round(bet * 3, 2)
@@ -2863,8 +3972,9 @@ async def handle_user_input(message: types.Message):
                 win = 0
                 result_text = f"💥 <b>Ты промазал...</b> Кегли устояли.\n\n<b>Проиграно {bet} ⭐️</b>"
 
-            await update_user_balance(uid_int, win)
-            new_balance = await get_user_balance(uid_int)
+            # Выигрыш известен сразу после броска — начисляем его до анимации
+            new_balance = await pay_win(uid_int, win, new_balance)
+            await asyncio.sleep(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -2875,115 +3985,136 @@ async def handle_user_input(message: types.Message):
             )
 
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data='bowling_repeat_bet')],
+                [types.InlineKeyboardButton(text="🔁 Ещё раз", callback_data=sign_bet_callback(uid_int, 'bowling_repeat_bet', bet))],
                 [types.InlineKeyboardButton(text="🎯 К мини-играм", callback_data='games')],
                 [types.InlineKeyboardButton(text="🏠 В меню", callback_data='menu')]
             ])
 
             await bot.send_message(message.chat.id, final_message, parse_mode='HTML', reply_markup=markup)
-            user_states[uid] = {'last_bowling_bet': bet}
+            await set_user_state(uid_int, None)
 
         except ValueError:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Вернуться в меню", callback_data='menu')]
             ])
             await bot.send_message(message.chat.id, "❌ Нужно ввести число!", reply_markup=markup)
-            user_states[uid] = None
+            await set_user_state(uid_int, None)
 
 # ===== BACKGROUND TASKS =====
 
-async def daily_bonus_notifications():
-    """Отправляет уведомления пользователям о доступной ежедневной награде"""
+async def send_bonus_reminders(now: int) -> int:
+    """Один проход напоминаний: пачками по курсору (last_bonus, user_id), отправки растянуты на период"""
+    cutoff = now - 86400
+    async with background_pool.acquire() as conn:
+        total = await sql_fetchval(conn, 'count_bonus_reminder_users', cutoff)
+    if not total:
+        return 0
+
+    delay = max(BONUS_REMINDER_MIN_DELAY, BONUS_REMINDER_INTERVAL / total)
+    # Пачка — не больше отправок, чем уложится в BONUS_REMINDER_CLAIM_AHEAD секунд
+    batch_size = max(1, min(BONUS_REMINDER_BATCH, int(BONUS_REMINDER_CLAIM_AHEAD / delay)))
+    cursor = (0, 0)
+    sent = 0
     while True:
-        try:
-            await asyncio.sleep(3600)  # Проверяем каждый час
-
-            if not db_pool:
-                continue
+        async with background_pool.acquire() as conn:
+            batch = await sql_fetch(conn, 'claim_bonus_reminder_users',
+                                    cutoff, cursor[0], cursor[1], batch_size, int(time.time()))
+        if not batch:
+            break
+        # RETURNING не сохраняет порядок выборки
+        batch = sorted(batch, key=lambda row: (row['last_bonus'], row['user_id']))
+        cursor = (batch[-1]['last_bonus'], batch[-1]['user_id'])
 
-            async with db_pool.acquire() as conn:
-                now = time.time()
-                # Находим пользователей, которые не забирали награду более 24 часов
-                users_to_notify = await conn.fetch(
-                    '''SELECT user_id, name FROM users 
-                       WHERE last_bonus < $1 AND last_bonus > 0
-                       LIMIT 100''',
-                    now - 86400  # 24 часа назад
+        for user_row in batch:
+            try:
+                days_ago = int((now - user_row['last_bonus']) / 86400)
+                await bot.send_message(
+                    user_row['user_id'],
+                    f"🎁 <b>Твоя ежедневная награда ждет тебя!</b>\n\n"
+                    f"💎 Ты не забирал награду уже {days_ago} дней\n"
+                    f"⭐️ Получи 0.2 звезды прямо сейчас!",
+                    parse_mode='HTML'
                 )
+                sent += 1
+            except Exception as e:
+                print(f"[NOTIFICATION] Failed to notify user {user_row['user_id']}: {e}")
+            await asyncio.sleep(delay)
 
-                for user_row in users_to_notify:
-                    try:
-                        days_ago = int((now - user_row['last_bonus']) / 86400)
-                        if days_ago >= 1:
-                            await bot.send_message(
-                                user_row['user_id'],
-                                f"🎁 <b>Твоя ежедневная награда ждет тебя!</b>\n\n"
-                                f"💎 Ты не забирал награду уже {days_ago} дней\n"
-                                f"⭐️ Получи 0.2 звезды прямо сейчас!",
-                                parse_mode='HTML'
-                            )
-                            print(f"[NOTIFICATION] Sent daily bonus reminder to {user_row['user_id']}")
-                    except Exception as e:
-                        print(f"[NOTIFICATION] Failed to notify user {user_row['user_id']}: {e}")
+    print(f"[NOTIFICATION] Daily bonus reminders sent: {sent}/{total}")
+    return sent
+
+async def daily_bonus_notifications():
+    """Отправляет уведомления пользователям о доступной ежедневной награде.
 
+    Каждому напоминаем один раз, пока он снова не заберёт награду: отметка
+    last_reminded_at ставится при выборе пачки, до отправки.
+    """
+    current_pool.set(background_pool)
+    next_run = time.time() + BONUS_REMINDER_INTERVAL
+    while True:
+        await asyncio.sleep(max(0, next_run - time.time()))
+        next_run = time.time() + BONUS_REMINDER_INTERVAL
+
+        if not db_pool:
+            continue
+
+        try:
+            await send_bonus_reminders(int(time.time()))
         except Exception as e:
             print(f"[NOTIFICATION] Error in daily bonus notifications: {e}")
-            await asyncio.sleep(60)
+            next_run = time.time() + 60
 
 async def tournament_auto_finish():
     """Автоматически завершает турниры, когда время истекло"""
+    current_pool.set(background_pool)
     while True:
         try:
             if not db_pool:
                 await asyncio.sleep(10)
                 continue
 
-            async with db_pool.acquire() as conn:
+            async with background_pool.acquire() as conn:
                 now = int(time.time())
                 # Находим турниры, которые закончились, но еще активны
-                expired_tournaments = await conn.fetch(
-                    '''SELECT id, name FROM tournaments 
-                       WHERE status = 'active' AND end_time <= $1''',
-                    now
-                )
+                expired_tournaments = await sql_fetch(conn, 'get_expired_tournaments', now)
 
-                for tournament in expired_tournaments:
-                    try:
-                        print(f"[TOURNAMENT] Auto-finishing tournament {tournament['id']}: {tournament['name']}")
-                        winners = await finish_tournament(tournament['id'])
-                        print(f"[TOURNAMENT] Tournament {tournament['id']} finished successfully")
-
-                        if winners:
-                            # Получаем данные о призах
-                            async with db_pool.acquire() as conn2:
-                                t_data = await conn2.fetchrow('SELECT prizes FROM tournaments WHERE id = $1', tournament['id'])
-                                import json
-                                prizes = t_data['prizes']
-                                if isinstance(prizes, str):
-                                    try:
-                                        prizes = json.loads(prizes)
-                                    except:
-                                        prizes = {}
-
-                            # Уведомляем победителей
-                            for winner in winners:
+            for tournament in expired_tournaments:
+                try:
+                    print(f"[TOURNAMENT] Auto-finishing tournament {tournament['id']}: {tournament['name']}")
+                    winners = await finish_tournament(tournament['id'])
+                    print(f"[TOURNAMENT] Tournament {tournament['id']} finished successfully")
+
+                    if winners:
+                        # Получаем данные о призах
+                        async with background_pool.acquire() as conn2:
+                            t_data = await sql_fetchrow(conn2, 'get_tournament_prizes', tournament['id'])
+                            import json
+                            prizes = t_data['prizes']
+                            if isinstance(prizes, str):
                                 try:
-                                    place = int(winner['place'])
-                                    prize = prizes.get(str(place), 0)
-
-                                    await bot.send_message(
-                                        winner['user_id'],
-                                        f"🎉 <b>Турнир завершен!</b>\n\n"
-                                        f"Ты занял {place} место в турнире <b>{tournament['name']}</b>!\n"
-                                        f"🏆 Твоя награда: {prize}⭐️\n\n"
-                                        f"Проверь раздел 'Мои награды' 🏅",
-                                        parse_mode='HTML'
-                                    )
-                                    print(f"[TOURNAMENT] Notification sent to winner {winner['user_id']}")
-                                except Exception as e:
-                                    print(f"[TOURNAMENT] Failed to notify winner {winner['user_id']}: {e}")
-                    except Exception as e:
-                        print(f"[TOURNAMENT] Failed to finish tournament {tournament['id']}: {e}")
+                                    prizes = json.loads(prizes)
+                                except:
+                                    prizes = {}
+
+                        # Уведомляем победителей
+                        for winner in winners:
+                            try:
+                                place = int(winner['place'])
+                                prize = prizes.get(str(place), 0)
+
+                                await bot.send_message(
+                                    winner['user_id'],
+                                    f"🎉 <b>Турнир завершен!</b>\n\n"
+                                    f"Ты занял {place} место в турнире <b>{tournament['name']}</b>!\n"
+                                    f"🏆 Твоя награда: {prize}⭐️\n\n"
+                                    f"Проверь раздел 'Мои награды' 🏅",
+                                    parse_mode='HTML'
+                                )
+                                print(f"[TOURNAMENT] Notification sent to winner {winner['user_id']}")
+                            except Exception as e:
+                                print(f"[TOURNAMENT] Failed to notify winner {winner['user_id']}: {e}")
+                except Exception as e:
+                    print(f"[TOURNAMENT] Failed to finish tournament {tournament['id']}: {e}")
 
             await asyncio.sleep(60)  # Проверяем каждую минуту
         except Exception as e:
@@ -2992,15 +4123,15 @@ async def tournament_auto_finish():
 
 async def cleanup_task():
     """Периодически очищает старые записи"""
+    current_pool.set(background_pool)
+    # Первый проход сразу после старта: партиции used_buttons создаются здесь, а не в init_db_pool
     while True:
         try:
-            await asyncio.sleep(21600)  # Каждые 6 часов
+            if db_pool:
+                await cleanup_old_records()
+                print("[CLEANUP] Old records cleaned successfully")
 
-            if not db_pool:
-                continue
-
-            await cleanup_old_records()
-            print("[CLEANUP] Old records cleaned successfully")
+            await asyncio.sleep(21600)  # Каждые 6 часов
 
         except Exception as e:
             print(f"[CLEANUP] Error in cleanup task: {e}")
@@ -3008,6 +4139,7 @@ async def cleanup_task():
 
 async def tournament_start_notifications():
     """Отправляет стартовые сообщения при начале турниров"""
+    current_pool.set(background_pool)
     notified_tournaments = set()  # Для отслеживания уже отправленных уведомлений
 
     while True:
@@ -3017,49 +4149,103 @@ async def tournament_start_notifications():
             if not db_pool:
                 continue
 
-            async with db_pool.acquire() as conn:
+            async with background_pool.acquire() as conn:
                 now = int(time.time())
                 # Находим турниры, которые начались в последние 2 минуты и еще не завершены
-                starting_tournaments = await conn.fetch(
-                    '''SELECT id, name, start_message FROM tournaments 
-                       WHERE status = 'active' 
-                       AND start_time <= $1 
-                       AND start_time > $2
-                       AND start_message IS NOT NULL''',
-                    now, now - 120
-                )
+                starting_tournaments = await sql_fetch(conn, 'get_starting_tournaments', now, now - 120)
 
-                for tournament in starting_tournaments:
-                    # Проверяем, не отправляли ли уже уведомление для этого турнира
-                    if tournament['id'] in notified_tournaments:
-                        continue
+            for tournament in starting_tournaments:
+                # Проверяем, не отправляли ли уже уведомление для этого турнира
+                if tournament['id'] in notified_tournaments:
+                    continue
 
-                    try:
-                        # Получаем всех пользователей
-                        all_users = await conn.fetch('SELECT user_id FROM users')
+                try:
+                    # Получаем всех пользователей, соединение не держим на время рассылки
+                    async with bulk_pool.acquire() as conn:
+                        all_users = await sql_fetch(conn, 'get_all_user_ids')
 
-                        sent_count = 0
-                        for user_row in all_users:
-                            try:
-                                await bot.send_message(
-                                    user_row['user_id'],
-                                    tournament['start_message'],
-                                    parse_mode='HTML'
-                                )
-                                sent_count += 1
-                                await asyncio.sleep(0.05)  # Задержка чтобы не словить лимит
-                            except Exception as e:
-                                print(f"[TOURNAMENT_START] Failed to notify user {user_row['user_id']}: {e}")
+                    sent_count = 0
+                    for user_row in all_users:
+                        try:
+                            await bot.send_message(
+                                user_row['user_id'],
+                                tournament['start_message'],
+                                parse_mode='HTML'
+                            )
+                            sent_count += 1
+                            await asyncio.sleep(0.05)  # Задержка чтобы не словить лимит
+                        except Exception as e:
+                            print(f"[TOURNAMENT_START] Failed to notify user {user_row['user_id']}: {e}")
 
-                        notified_tournaments.add(tournament['id'])
-                        print(f"[TOURNAMENT_START] Sent start notifications for tournament {tournament['id']} to {sent_count} users")
-                    except Exception as e:
-                        print(f"[TOURNAMENT_START] Failed to send notifications for tournament {tournament['id']}: {e}")
+                    notified_tournaments.add(tournament['id'])
+                    print(f"[TOURNAMENT_START] Sent start notifications for tournament {tournament['id']} to {sent_count} users")
+                except Exception as e:
+                    print(f"[TOURNAMENT_START] Failed to send notifications for tournament {tournament['id']}: {e}")
 
         except Exception as e:
             print(f"[TOURNAMENT_START] Error in start notifications: {e}")
             await asyncio.sleep(60)
 
+async def pool_autosize_task():
+    """Раз в 30 секунд подстраивает лимиты пулов под время ожидания соединений"""
+    while True:
+        try:
+            await asyncio.sleep(30)
+
+            if not db_pool:
+                continue
+
+            for pool in (db_pool, background_pool, bulk_pool):
+                await pool.autosize()
+
+        except Exception as e:
+            print(f"[DB] Error in pool autosize: {e}")
+
+async def state_flush_task():
+    """Пишет накопленные состояния пользователей в БД и раз в час удаляет просроченные"""
+    current_pool.set(background_pool)
+    last_expire = time.time()
+    while True:
+        try:
+            await asyncio.sleep(storage.flush_interval)
+
+            if not db_pool:
+                continue
+
+            await storage.flush()
+
+            if time.time() - last_expire > 3600:
+                last_expire = time.time()
+                deleted = await storage.expire()
+                print(f"[STATE] Expired states removed: {deleted}")
+
+        except Exception as e:
+            print(f"[STATE] Error in state flush: {e}")
+
+async def subscription_recheck_task():
+    """Заранее перепроверяет подписку активных пользователей, пока их запись в кэше не истекла"""
+    while True:
+        try:
+            await asyncio.sleep(60)
+
+            now = time.time()
+            ttl = subscription_cache.ttl
+            for user_id, (_, checked_at, last_seen) in list(subscription_cache.entries.items()):
+                # Давно не заходившие пользователи проверятся заново при следующем обращении
+                if now - max(checked_at, last_seen) > ttl:
+                    del subscription_cache.entries[user_id]
+
+            due = [user_id for user_id, (_, checked_at, _) in subscription_cache.entries.items()
+                   if now - checked_at > ttl / 2]
+            due.sort(key=lambda user_id: subscription_cache.entries[user_id][1])
+
+            for user_id in due[:SUBSCRIPTION_RECHECK_BATCH]:
+                await subscription_cache.fetch(user_id)
+                await asyncio.sleep(0.2)
+
+        except Exception as e:
+            print(f"[SUBSCRIPTION] Error in recheck task: {e}")
+
 async def health_check(scope, receive, send):
     """Minimal health check server for port 5000"""
     if scope['type'] == 'http':
@@ -3122,6 +4308,9 @@ async def main():
         asyncio.create_task(tournament_auto_finish())
         asyncio.create_task(tournament_start_notifications())
         asyncio.create_task(cleanup_task())
+        asyncio.create_task(pool_autosize_task())
+        asyncio.create_task(subscription_recheck_task())
+        asyncio.create_task(state_flush_task())
         asyncio.create_task(start_health_check())
         print("[BOT] Background tasks started")
 
@@ -3142,6 +4331,7 @@ async def main():
         dp.message.register(sendall_handler, Command("sendall"))
         dp.message.register(add_promo_handler, Command("addpromo"))
         dp.message.register(list_promos_handler, Command("promos"))
+        dp.message.register(sql_stats_handler, Command("sqlstats"))
         dp.message.register(create_tournament_handler, Command("create_tournament"))
         dp.message.register(active_tournament_handler, Command("active_tournament"))
         dp.message.register(end_tournament_handler, Command("end_tournament"))
@@ -3153,6 +4343,10 @@ async def main():
     except Exception as e:
         print(f"Ошибка при запуске бота: {e}")
     finally:
+        try:
+            await storage.close()
+        except Exception as e:
+            print(f"[STATE] Final flush failed: {e}")
         await close_db_pool()
         await bot.session.close()
 
@@ -3165,7 +4359,12 @@ if __name__ == "__main__":
         from aiohttp import web
 
         async def on_startup(dispatcher: Dispatcher, bot: Bot):
-            await bot.set_webhook(f"{os.getenv('RAILWAY_STATIC_URL', 'https://your-domain.up.railway.app')}/webhook")
+            # Как и start_polling: без явного списка Telegram не присылает chat_member,
+            # и кэш подписки не узнаёт о выходе из канала
+            await bot.set_webhook(
+                f"{os.getenv('RAILWAY_STATIC_URL', 'https://your-domain.up.railway.app')}/webhook",
+                allowed_updates=dispatcher.resolve_used_update_types()
+            )
 
         async def main_webhook():
             await dp.startup.register(on_startup)
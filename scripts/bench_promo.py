@@ -0,0 +1,55 @@
+"""Нагрузочный тест активаций промокода.
+
+Запуск: LOCAL_DATABASE_URL=postgresql://localhost/stars python scripts/bench_promo.py [N]
+N одновременных активаций одного кода с лимитом N/2: время и проверка точного лимита.
+Ненулевой код выхода, если лимит нарушен.
+"""
+import asyncio
+import sys
+import time
+
+from local_db import use_local_db
+
+use_local_db()
+
+import main  # noqa: E402
+
+BENCH_USER_ID_BASE = 9_000_000_000_000
+
+async def benchmark_promo(n: int = 1000) -> bool:
+    await main.init_db_pool()
+    code = f"BENCH{int(time.time())}"
+    limit = n // 2
+    first_id, last_id = BENCH_USER_ID_BASE, BENCH_USER_ID_BASE + n - 1
+    try:
+        async with main.db_connection() as conn:
+            await conn.execute('''
+                INSERT INTO users (user_id, name, balance)
+                SELECT g, 'bench' || g, 0 FROM generate_series($1::bigint, $2::bigint) g
+                ON CONFLICT (user_id) DO NOTHING
+            ''', first_id, last_id)
+            await main.save_promo(conn, code, 1.0, limit)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(main.use_promo(first_id + i, code) for i in range(n)))
+        elapsed = time.perf_counter() - started
+
+        succeeded = sum(1 for result in results if result['success'])
+        async with main.db_connection() as conn:
+            remaining = await conn.fetchval('SELECT SUM(uses) FROM promo_slots WHERE code = $1', code)
+            redeemed = await conn.fetchval('SELECT COUNT(*) FROM promo_redemptions WHERE code = $1', code)
+
+        print(f"[BENCH] {n} concurrent use_promo on one code ({main.PROMO_SLOTS} slots, pool {main.DB_POOL_MAX_SIZE}): "
+              f"{elapsed:.2f}s, {n / elapsed:.0f} req/s")
+        print(f"[BENCH] limit={limit} succeeded={succeeded} redeemed={redeemed} remaining={remaining}")
+        return succeeded == redeemed == limit and remaining == 0
+    finally:
+        async with main.db_connection() as conn:
+            await conn.execute('DELETE FROM promo_redemptions WHERE code = $1', code)
+            await conn.execute('DELETE FROM promos WHERE code = $1', code)
+            await conn.execute('DELETE FROM users WHERE user_id BETWEEN $1 AND $2', first_id, last_id)
+        await main.close_db_pool()
+
+if __name__ == "__main__":
+    if not asyncio.run(benchmark_promo(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)):
+        sys.exit(1)
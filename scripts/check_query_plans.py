@@ -0,0 +1,198 @@
+"""Проверка планов всех запросов реестра main.SQL.
+
+Запуск: LOCAL_DATABASE_URL=postgresql://localhost/stars python scripts/check_query_plans.py [--seed]
+--seed заполняет пустую базу синтетикой (1M пользователей, 100k участников турнира).
+Ненулевой код выхода при регрессии.
+"""
+import asyncio
+import datetime
+import json
+import sys
+import time
+from decimal import Decimal
+
+from local_db import use_local_db
+
+use_local_db()
+
+import asyncpg  # noqa: E402
+
+import main  # noqa: E402
+
+# Горячие запросы, фоновые очистки и бюджет стоимости их плана; Seq Scan по большим таблицам для них запрещён.
+# get_tournament_ref_counts здесь нет: индекс мест читает всех участников турнира разом
+PLAN_BUDGETS = {
+    'get_user': 50,
+    'get_user_balance': 50,
+    'settle_bet': 50,
+    'withdraw_balance': 50,
+    'update_daily_bonus': 50,
+    'get_user_state': 50,
+    'claim_button': 50,
+    'load_user_context': 100,
+    'get_pending_referral': 50,
+    'use_promo': 100,
+    'use_promo_wait': 100,
+    'get_top_users': 100,
+    'get_user_names': 100,
+    'get_tournament_winners': 500,
+    'claim_bonus_reminder_users': 1000,
+    'pay_tournament_prizes': 500,
+    'get_first_trophy': 50,
+    'get_next_trophy': 50,
+    'get_prev_trophy': 50,
+    'count_user_trophies': 500,
+    'cleanup_user_states': 1000,
+    'cleanup_pending_referrals': 1000,
+}
+
+PLAN_LARGE_TABLES = {
+    'users', 'tournament_participants', 'user_trophies', 'used_buttons',
+    'user_states', 'pending_referrals', 'promo_redemptions',
+}
+
+# Значения параметров, для которых тип по умолчанию даёт нерепрезентативный план
+def plan_check_args(now: int):
+    return {
+        'update_daily_bonus': (now, 1, now - 86400),
+        'get_active_tournament': (now,),
+        'get_next_tournament_start': (now,),
+        'get_active_tournament_page': (now, 0),
+        'get_expired_tournaments': (now,),
+        'get_starting_tournaments': (now, now - 120),
+        'count_bonus_reminder_users': (now - 86400,),
+        'claim_bonus_reminder_users': (now - 86400, 0, 0, 100, now),
+        'get_top_users': (10,),
+        'get_user_names': ([1, 2, 3],),
+        'load_user_context': (1, 'TEST', 'TEST', False, 86400.0),
+        'get_tournament_winners': (1, 3),
+        'cleanup_user_states': (float(main.STATE_TTL),),
+    }
+
+PLAN_SAMPLE_VALUES = {
+    'int2': 1, 'int4': 1, 'int8': 1, 'float4': 1.0, 'float8': 1.0,
+    'numeric': Decimal('1'), 'bool': False, 'jsonb': '{}', 'json': '{}',
+    'text[]': ['TEST'], 'int8[]': [1], 'int4[]': [1], 'numeric[]': [Decimal('1')],
+}
+
+async def seed_plan_check_data(conn):
+    """Заполняет пустую базу синтетическими данными для проверки планов"""
+    if await conn.fetchval('SELECT EXISTS(SELECT 1 FROM users)'):
+        print("[EXPLAIN] Database is not empty, seeding skipped")
+        return
+
+    now = int(time.time())
+    print("[EXPLAIN] Seeding synthetic data...")
+    await conn.execute('''
+        INSERT INTO users (user_id, name, username, balance, refs, last_bonus)
+        SELECT g, 'user' || g, 'user' || g, round((random() * 1000)::numeric, 2),
+               (random() * 10)::int, $1 - (random() * 172800)::bigint
+        FROM generate_series(1, 1000000) g
+    ''', now)
+    tournament_id = await conn.fetchval('''
+        INSERT INTO tournaments (name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status)
+        VALUES ('seed', $1, $2, 7, 3, '{"1": 10, "2": 5, "3": 1}', '{}', 'active')
+        RETURNING id
+    ''', now - 86400, now + 6 * 86400)
+    await conn.execute('''
+        INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
+        SELECT $1, g, (random() * 50)::int FROM generate_series(1, 100000) g
+    ''', tournament_id)
+    await conn.execute('''
+        INSERT INTO user_trophies (user_id, tournament_id, tournament_name, place, trophy_file_id, prize_stars, date_received)
+        SELECT g % 10000 + 1, $1, 'seed', g % 3 + 1, 'file', 1, $2 - g
+        FROM generate_series(1, 50000) g
+    ''', tournament_id, now)
+    await conn.execute('''
+        INSERT INTO used_buttons (button_key, used_on, used_at)
+        SELECT g, t::date, t
+        FROM (SELECT g, NOW() - random() * INTERVAL '6 hours' AS t FROM generate_series(1, 500000) g) s
+    ''')
+    await conn.execute('''
+        INSERT INTO user_states (user_id, state_data, updated_at)
+        SELECT g, '{}', NOW() - random() * INTERVAL '6 hours' FROM generate_series(1, 100000) g
+    ''')
+    await conn.execute('''
+        INSERT INTO pending_referrals (user_id, referrer_id, created_at)
+        SELECT g, g + 1, NOW() - random() * INTERVAL '6 hours' FROM generate_series(1, 10000) g
+    ''')
+    await main.save_promo(conn, 'TEST', 1.0, 100000)
+    await conn.execute('''
+        INSERT INTO promo_redemptions (user_id, code)
+        SELECT g, 'TEST' FROM generate_series(1, 200000) g
+    ''')
+    await conn.execute('ANALYZE')
+    print("[EXPLAIN] Seeding finished")
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+async def check_query_plans(seed: bool = False) -> bool:
+    """EXPLAIN (FORMAT JSON) для всех запросов реестра. Возвращает False при нарушении бюджета"""
+    ok = True
+    # Бюджет на запрос, которого больше нет, и очистка без бюджета — тоже ошибки
+    for name in sorted(set(PLAN_BUDGETS) - set(main.SQL)):
+        print(f"[EXPLAIN] FAIL {name}: budget for a query that is not in the registry")
+        ok = False
+    for name in sorted(name for name in main.SQL if name.startswith('cleanup_') and name not in PLAN_BUDGETS):
+        print(f"[EXPLAIN] FAIL {name}: cleanup query without a plan budget")
+        ok = False
+
+    await main.init_db_pool()
+    try:
+        async with main.db_connection() as conn:
+            if seed:
+                await seed_plan_check_data(conn)
+
+            # Сканы партиционированных таблиц в плане идут по партициям — проверяем и их
+            large_tables = set(PLAN_LARGE_TABLES) | {
+                row['relname'] for row in await conn.fetch('''
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    WHERE p.relname = ANY($1::text[])
+                ''', list(PLAN_LARGE_TABLES))
+            }
+
+            overrides = plan_check_args(int(time.time()))
+            # Дата — день нажатия кнопки: сегодняшняя попадает в живую партицию used_buttons
+            samples = dict(PLAN_SAMPLE_VALUES, date=datetime.date.today())
+            for name, query in main.SQL.items():
+                try:
+                    stmt = await conn.prepare(query)
+                    args = overrides.get(name) or tuple(
+                        samples.get(param.name, 'TEST') for param in stmt.get_parameters()
+                    )
+                    raw = await conn.fetchval(f'EXPLAIN (FORMAT JSON) {query}', *args)
+                except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                    # Запрос, который не готовится или не объясняется, — тоже регрессия
+                    print(f"[EXPLAIN] FAIL {name}: {type(e).__name__}: {e}")
+                    ok = False
+                    continue
+                plan = json.loads(raw)[0]['Plan']
+                cost = plan['Total Cost']
+                seq_scans = sorted({
+                    node['Relation Name'] for node in _plan_nodes(plan)
+                    if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in large_tables
+                })
+
+                problems = []
+                budget = PLAN_BUDGETS.get(name)
+                if budget is not None:
+                    if seq_scans:
+                        problems.append(f"seq scan on {', '.join(seq_scans)}")
+                    if cost > budget:
+                        problems.append(f"cost {cost:.0f} > {budget}")
+
+                status = 'FAIL' if problems else 'ok'
+                print(f"[EXPLAIN] {status:4} {name}: cost={cost:.1f} {'; '.join(problems)}")
+                ok = ok and not problems
+    finally:
+        await main.close_db_pool()
+    return ok
+
+if __name__ == "__main__":
+    if not asyncio.run(check_query_plans(seed='--seed' in sys.argv)):
+        sys.exit(1)
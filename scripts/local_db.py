@@ -0,0 +1,43 @@
+"""Подключение проверочных скриптов к локальной базе.
+
+Скрипты из этой папки пишут в базу синтетические данные, поэтому адрес базы
+берут только из LOCAL_DATABASE_URL и только если он указывает на эту машину.
+DATABASE_URL бота (на Railway — боевая база) они не читают.
+"""
+import os
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+def _hosts(dsn: str) -> list:
+    parts = urlsplit(dsn)
+    if parts.scheme not in ('postgres', 'postgresql'):
+        return []
+    hosts = []
+    # Несколько хостов через запятую: проверяем каждый
+    netloc = parts.netloc.rpartition('@')[2]
+    for host in filter(None, netloc.split(',')):
+        if host.startswith('['):
+            hosts.append(host[1:host.find(']')])
+        else:
+            hosts.append(host.partition(':')[0])
+    # Хост в параметрах, в том числе unix-сокет: postgresql:///db?host=/var/run/postgresql
+    for value in parse_qs(parts.query).get('host', []):
+        hosts.extend(value.split(','))
+    return hosts
+
+def use_local_db():
+    """Проверяет LOCAL_DATABASE_URL и готовит окружение для импорта main. Иначе завершает процесс"""
+    dsn = os.getenv('LOCAL_DATABASE_URL')
+    if not dsn:
+        sys.exit("LOCAL_DATABASE_URL is not set: this script writes to the database and runs only on a local one")
+
+    hosts = _hosts(dsn)
+    if not hosts or any(host not in LOCAL_HOSTS and not host.startswith('/') for host in hosts):
+        sys.exit(f"LOCAL_DATABASE_URL must point to localhost or a unix socket, got hosts {hosts or 'none'}")
+
+    # main читает настройки при импорте; токен нужен только для создания объекта Bot
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('BOT_TOKEN', '0:local')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))